@@ -11,6 +11,11 @@ from app.classification.view import router as classification_router
 from app.models.view import router as model_router
 from app.db.view import router as db_router
 from app.test.view import router as test_router
+from app.classification.service import schema_catalog, schema_index
+from app.db.service import connection_pools
+from app.generation.service import grammar_cache, pipeline
+from app.prompts.builder import precompile_templates
+from app.generation.model import ExtractTables, ExtractColumns
 
 import os
 
@@ -20,6 +25,20 @@ if not load_dotenv(dotenv_path=os.getcwd() + "/app/.env", verbose=True):
     print("Failed to load .env file current path is:")
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warms the in-memory caches before the first request is served
+    and closes the pooled database connections on shutdown.
+    """
+    schema_catalog.warm()
+    schema_index.warm()
+    precompile_templates()
+    grammar_cache.warm([pipeline.sql_response_format(), ExtractTables, ExtractColumns])
+    yield
+    connection_pools.close()
+
+
 app = FastAPI(
     title="NLIDB",
     description="LLM-powered text-to-sql tool",
@@ -32,4 +51,5 @@ app = FastAPI(
         *test_router.routes
     ],
     dependencies=[],
+    lifespan=lifespan,
 )
\ No newline at end of file
@@ -0,0 +1,134 @@
+from typing import Optional
+import importlib.resources as pkg_resources
+import os
+import threading
+import time
+import numpy as np
+import torch
+from transformers import AutoTokenizer, BertForSequenceClassification
+
+
+class BertTableClassifier:
+    """
+    CPU inference backend for the multi-label BERT table classifier trained by
+    `classifiers/multi_label_table_classifier.py`.
+
+    The Linear layers are quantized to dynamic int8 unless `quantize` is unset, inputs are
+    padded to the longest query of a length-sorted sub-batch instead of `max_length`, and
+    probabilities are restricted to the tables of the query's database.
+    """
+    def __init__(
+        self,
+        model_dir: str,
+        quantize: bool = True,
+        max_len: int = 128,
+        batch_size: int = 32,
+        threshold: float = 0.5,
+    ):
+        self.model_dir = model_dir
+        self.quantize = quantize
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.threshold = threshold
+
+        threads = os.getenv("BERT_NUM_THREADS")
+        if threads:
+            torch.set_num_threads(int(threads))
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        model = BertForSequenceClassification.from_pretrained(model_dir).eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        # Set by the training script, label i is the table name of logit i
+        self.labels = [model.config.id2label[i] for i in range(model.config.num_labels)]
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        # torch intra-op threads already parallelize one batch, run batches one at a time
+        self.lock = threading.Lock()
+
+    def database_columns(self, tables: list[str]) -> np.ndarray:
+        return np.array([self.label_index[table] for table in tables if table in self.label_index])
+
+    def probabilities(self, texts: list[str]) -> np.ndarray:
+        """
+        Sigmoid outputs for every text, computed in length-sorted, dynamically padded batches.
+        """
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        outputs = np.empty((len(texts), len(self.labels)), dtype=np.float32)
+        with self.lock, torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                indices = order[start:start + self.batch_size]
+                inputs = self.tokenizer(
+                    [texts[i] for i in indices],
+                    padding="longest",
+                    truncation=True,
+                    max_length=self.max_len,
+                    return_tensors="pt",
+                )
+                logits = self.model(**inputs).logits
+                outputs[indices] = torch.sigmoid(logits).numpy()
+        return outputs
+
+    def predict(self, queries: list[tuple[str, str, list[str]]]) -> list[tuple[list[str], float]]:
+        """
+        Predicts the tables of (nlq, db, table names of db) queries.
+
+        Returns:
+            list[tuple[list[str], float]]: The tables above the threshold (at least the most
+            likely one) and the least certain include/exclude decision as the confidence.
+        """
+        # Same input format as in training
+        probabilities = self.probabilities([f"{nlq} [SEP] {db}" for nlq, db, _ in queries])
+        results = []
+        for row, (_, db, tables) in zip(probabilities, queries):
+            columns = self.database_columns(tables)
+            if not len(columns):
+                results.append(([], 0.0))
+                continue
+            scores = row[columns]
+            selected = {int(np.argmax(scores))} | set(np.flatnonzero(scores >= self.threshold).tolist())
+            confidence = float(np.min(np.maximum(scores, 1 - scores)))
+            results.append(([self.labels[columns[i]] for i in sorted(selected)], confidence))
+        return results
+
+    def benchmark(self, queries: list[tuple[str, str, list[str]]], batch_sizes: tuple = (1, 8, 32)) -> list[dict]:
+        """
+        Latency percentiles per query batch and throughput of `predict` for several batch sizes.
+        """
+        report = []
+        default_batch_size = self.batch_size
+        try:
+            for batch_size in batch_sizes:
+                self.batch_size = batch_size
+                self.predict(queries[:batch_size])  # warm-up
+                latencies = []
+                started = time.perf_counter()
+                for start in range(0, len(queries), batch_size):
+                    batch_started = time.perf_counter()
+                    self.predict(queries[start:start + batch_size])
+                    latencies.append(time.perf_counter() - batch_started)
+                elapsed = time.perf_counter() - started
+                report.append({
+                    "quantized": self.quantize,
+                    "batch_size": batch_size,
+                    "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                    "p95_ms": float(np.percentile(latencies, 95) * 1000),
+                    "queries_per_second": len(queries) / elapsed,
+                })
+        finally:
+            self.batch_size = default_batch_size
+        return report
+
+
+def load_bert_table_classifier(model_dir: Optional[str] = None) -> BertTableClassifier:
+    """
+    Loads the classifier configured by BERT_TABLE_MODEL_DIR (default app/models/multi_label_model)
+    and BERT_QUANTIZE (default true).
+    """
+    model_dir = model_dir or os.getenv("BERT_TABLE_MODEL_DIR") or \
+        pkg_resources.files("app.models").joinpath("multi_label_model").as_posix()
+    return BertTableClassifier(
+        model_dir=model_dir,
+        quantize=os.getenv("BERT_QUANTIZE", "true").lower() not in ("0", "false", "no"),
+        batch_size=int(os.getenv("BERT_BATCH_SIZE", "32")),
+        threshold=float(os.getenv("BERT_THRESHOLD", "0.5")),
+    )
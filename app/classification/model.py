@@ -1,17 +1,41 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Literal, Optional
 
 class DBClassificationRequest(BaseModel):
     nlq: str
+
+class DBBatchClassificationRequest(BaseModel):
+    nlqs: list[str]
+    top_k: int = Field(3, ge=1)
     
 class TableClassificationRequest(BaseModel):
     nlq: str
     db: Optional[str] = None
+    cache: bool = True
 
 class ColumnsClassificationRequest(BaseModel):
     nlq: str
     db: Optional[str] = None
     tables: Optional[list[str]]
+    cache: bool = True
 
 class AllClassificationRequest(BaseModel):
-    nlq: str
\ No newline at end of file
+    nlq: str
+    cache: bool = True
+
+class ColumnDescription(BaseModel):
+    """
+    A single column record read from a `database_description` CSV file.
+    """
+    name: str
+    description: str
+    data_format: str
+    value_description: str
+
+class TableDescription(BaseModel):
+    """
+    All column records of one table.
+    """
+    name: str
+    columns: list[ColumnDescription]
+    mtime: float
@@ -1,5 +1,16 @@
+from typing import Callable, Optional
+from collections import Counter
+import asyncio
 import joblib
 import importlib.resources as pkg_resources
+import json
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from app.classification.model import ColumnDescription, TableDescription
 
 class ClassificationEngine:
     def __init__(self):
@@ -9,11 +20,12 @@ class ClassificationEngine:
                 "vectorizer_path": pkg_resources.files("app.models").joinpath("db_tfidf_vectorizer.pkl"),
                 "label_mapping_path": pkg_resources.files("app.models").joinpath("db_label_mapping.pkl"),
             },
-            # "table": {
-            #     "model_path": pkg_resources.files("app.models").joinpath("table_logistic_model.pkl"),
-            #     "vectorizer_path": pkg_resources.files("app.models").joinpath("table_tfidf_vectorizer.pkl"),
-            #     "label_mapping_path": pkg_resources.files("app.models").joinpath("table_label_mapping.pkl"),
-            # },
+            # Labels are whole table sets "db:table1,table2", see classifiers/table_classifier.py
+            "table": {
+                "model_path": pkg_resources.files("app.models").joinpath("table_logistic_model.pkl"),
+                "vectorizer_path": pkg_resources.files("app.models").joinpath("table_tfidf_vectorizer.pkl"),
+                "label_mapping_path": pkg_resources.files("app.models").joinpath("table_label_mapping.pkl"),
+            },
             # "column": {
             #     "model_path": pkg_resources.files("app.models").joinpath("column_logistic_model.pkl"),
             #     "vectorizer_path": pkg_resources.files("app.models").joinpath("column_tfidf_vectorizer.pkl"),
@@ -34,6 +46,42 @@ class ClassificationEngine:
                 "reverse_label_mapping": reverse_label_mapping,
             }
 
+        # Coefficients of the table sets of every database. The model is multinomial, so the
+        # probabilities renormalized within a database are a softmax over its logits alone.
+        table_engine = self.engines["table"]
+        table_sets: dict[str, tuple[list[int], list[list[str]]]] = {}
+        for row, idx in enumerate(table_engine["model"].classes_):
+            db, tables = table_engine["reverse_label_mapping"][idx].split(":", 1)
+            rows, sets = table_sets.setdefault(db, ([], []))
+            rows.append(row)
+            sets.append(tables.split(","))
+        self.table_sets = {
+            db: (
+                np.ascontiguousarray(table_engine["model"].coef_[rows].T),
+                table_engine["model"].intercept_[rows],
+                sets,
+            )
+            for db, (rows, sets) in table_sets.items()
+        }
+
+        # Optional BERT backend for tables, loaded on first use
+        self.bert = None
+        self.bert_lock = threading.Lock()
+
+    def bert_classifier(self):
+        """
+        Returns the BERT table classifier when TABLE_CLASSIFIER_BACKEND is "bert", else None.
+        Read on use, the .env file is loaded after this module is imported; torch is only
+        imported when the backend is selected.
+        """
+        if os.getenv("TABLE_CLASSIFIER_BACKEND", "tfidf") != "bert":
+            return None
+        with self.bert_lock:
+            if self.bert is None:
+                from app.classification.bert import load_bert_table_classifier
+                self.bert = load_bert_table_classifier()
+            return self.bert
+
     def classify(self, nlq: str, classification_type: str):
         """
         Predicts the label based on the classification type.
@@ -49,3 +97,519 @@ class ClassificationEngine:
         prediction_idx = engine["model"].predict(query_vectorized)[0]
         predicted_label = engine["reverse_label_mapping"][prediction_idx] 
         return predicted_label
+
+    def classify_tables(self, nlq: str, db: str) -> tuple[list[str], float]:
+        """
+        Predicts the table set of the query within a database.
+        :param nlq: The natural language query string.
+        :param db: The database the query was classified into.
+        :return: The (lowercase) table names and their probability among the database's table sets.
+        """
+        if db not in self.table_sets:
+            raise ValueError(f"No table classifier labels for database: {db}")
+
+        coef, intercept, table_sets = self.table_sets[db]
+        logits = (self.engines["table"]["vectorizer"].transform([nlq]) @ coef)[0] + intercept
+        probabilities = np.exp(logits - logits.max())
+        best = int(np.argmax(probabilities))
+        return table_sets[best], float(probabilities[best] / probabilities.sum())
+
+    def classify_tables_batch(self, queries: list[tuple[str, str]]) -> list:
+        """
+        Predicts the tables of many (nlq, db) queries with the TABLE_CLASSIFIER_BACKEND
+        ("tfidf" table sets or "bert" multi-label).
+        :return: (tables, confidence) per query, or the ValueError of a query that cannot be classified.
+        """
+        bert = self.bert_classifier()
+        if bert is None:
+            results = []
+            for nlq, db in queries:
+                try:
+                    results.append(self.classify_tables(nlq, db))
+                except ValueError as e:
+                    results.append(e)
+            return results
+
+        databases = set(schema_catalog.databases())
+        predictions = iter(bert.predict([
+            (nlq, db, [table.lower() for table in schema_catalog.get_tables(db)])
+            for nlq, db in queries if db in databases
+        ]))
+        return [
+            next(predictions) if db in databases else ValueError(f"Unknown database: {db}")
+            for _, db in queries
+        ]
+
+    def classify_top_k(self, queries: list[tuple[str, int]], classification_type: str = "db") -> list[list[tuple[str, float]]]:
+        """
+        `classify_batch` for (nlq, top_k) queries with their own k.
+        """
+        rankings = self.classify_batch(
+            [nlq for nlq, _ in queries], classification_type, max((top_k for _, top_k in queries), default=1)
+        )
+        return [ranking[:top_k] for (_, top_k), ranking in zip(queries, rankings)]
+
+    def classify_batch(self, nlqs: list[str], classification_type: str, top_k: int = 1) -> list[list[tuple[str, float]]]:
+        """
+        Scores many NLQs with one vectorizer and one `predict_proba` call.
+        :param nlqs: The natural language query strings.
+        :param classification_type: Type of classification ('db', 'table', or 'column').
+        :param top_k: Number of labels to return per query.
+        :return: For every query, the top-k (label, probability) pairs, most likely first.
+        """
+        if classification_type not in self.engines:
+            raise ValueError(f"Unsupported classification type: {classification_type}")
+        if not nlqs:
+            return []
+
+        engine = self.engines[classification_type]
+        probabilities = engine["model"].predict_proba(engine["vectorizer"].transform(nlqs))
+        top_k = max(1, min(top_k, probabilities.shape[1]))
+        # argpartition picks the top-k columns without sorting every class
+        top = np.argpartition(-probabilities, top_k - 1, axis=1)[:, :top_k]
+        top_probabilities = np.take_along_axis(probabilities, top, axis=1)
+        order = np.argsort(-top_probabilities, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        labels = engine["model"].classes_
+        return [
+            [
+                (engine["reverse_label_mapping"][labels[index]], float(probabilities[row, index]))
+                for index in top[row]
+            ]
+            for row in range(len(nlqs))
+        ]
+
+
+class ClassificationBatcher:
+    """
+    Coalesces concurrent single-query classifications into one call of a batch `predict` function.
+    A batch is flushed after CLASSIFICATION_BATCH_WINDOW_MS milliseconds (default 2)
+    or as soon as CLASSIFICATION_MAX_BATCH_SIZE (default 64) queries are waiting.
+    `predict` runs in a worker thread and returns one result (or exception) per query.
+    """
+    def __init__(self, predict: Callable[[list], list]):
+        self.predict = predict
+        self.pending: list[tuple[object, asyncio.Future]] = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def classify(self, query):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((query, future))
+        if len(self.pending) >= int(os.getenv("CLASSIFICATION_MAX_BATCH_SIZE", "64")):
+            self.flush()
+        elif self.flush_handle is None:
+            window = float(os.getenv("CLASSIFICATION_BATCH_WINDOW_MS", "2")) / 1000
+            self.flush_handle = loop.call_later(window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run(batch))
+            # Keep a reference until the batch is done
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: list[tuple[object, asyncio.Future]]):
+        try:
+            results = await asyncio.to_thread(self.predict, [query for query, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class SchemaCatalog:
+    """
+    In-memory catalog of the `database_description` CSV files of the dev databases.
+    Each table is parsed once and only re-read when the modification time of its
+    CSV file changes.
+    """
+    def __init__(self, package: str = "app.dev_databases"):
+        self.package = package
+        self.tables: dict[str, dict[str, TableDescription]] = {}
+        self.lock = threading.Lock()
+
+    def databases(self) -> list[str]:
+        """
+        Lists the databases that ship a `database_description` directory.
+        """
+        base_path = pkg_resources.files(self.package)
+        return sorted(
+            entry.name for entry in base_path.iterdir()
+            if entry.joinpath("database_description").is_dir()
+        )
+
+    def warm(self):
+        """
+        Loads every known database into the catalog, e.g. at application startup.
+        """
+        for db_name in self.databases():
+            self.get_tables(db_name)
+
+    def description_path(self, db_name: str) -> str:
+        base_path = pkg_resources.files(f"{self.package}.{db_name}.database_description")
+        if not os.path.exists(base_path):
+            raise FileNotFoundError(f"Database description path not found: {base_path}")
+        return str(base_path)
+
+    @staticmethod
+    def load_table(table_path: str, table_name: str, mtime: float) -> TableDescription:
+        try:
+            table_data = pd.read_csv(table_path)
+        except UnicodeDecodeError:
+            # A few BIRD description files are cp1252 encoded
+            table_data = pd.read_csv(table_path, encoding="cp1252")
+
+        fields = ["original_column_name", "column_description", "data_format", "value_description"]
+        columns = [
+            ColumnDescription(
+                name=str(name),
+                description=str(description),
+                data_format=str(data_format),
+                value_description=str(value_description),
+            )
+            for name, description, data_format, value_description
+            in table_data[fields].itertuples(index=False, name=None)
+        ]
+        return TableDescription(
+            name=table_name,
+            columns=columns,
+            mtime=mtime,
+        )
+
+    @staticmethod
+    def format_columns(table_name: str, columns: list[ColumnDescription]) -> str:
+        """
+        Renders a table and its column records as prompt text.
+        """
+        column_descriptions = [
+            f"- {column.name}: {column.description} "
+            f"(Data Format: {column.data_format}, Value Description: {column.value_description})"
+            for column in columns
+        ]
+        return f"Table: {table_name}\n\tColumns Info:\n\t\t" + "\n\t\t".join(column_descriptions)
+
+    def get_tables(self, db_name: str) -> dict[str, TableDescription]:
+        """
+        Returns the table records of a database, reloading any CSV file that changed on disk.
+
+        Args:
+            db_name (str): The name of the database.
+
+        Returns:
+            dict[str, TableDescription]: Table records keyed by table name.
+        """
+        base_path = self.description_path(db_name)
+        with self.lock:
+            tables = self.tables.setdefault(db_name, {})
+            seen = set()
+            with os.scandir(base_path) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".csv"):
+                        continue
+                    table_name = os.path.splitext(entry.name)[0]
+                    mtime = entry.stat().st_mtime
+                    seen.add(table_name)
+                    cached = tables.get(table_name)
+                    if cached is None or cached.mtime != mtime:
+                        tables[table_name] = self.load_table(entry.path, table_name, mtime)
+            for table_name in set(tables) - seen:
+                del tables[table_name]
+            return dict(tables)
+
+
+schema_catalog = SchemaCatalog()
+
+
+CAMEL_CASE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+
+def identifier_words(name: str) -> str:
+    """
+    Splits a snake_case or camelCase identifier into lowercase words.
+    """
+    return CAMEL_CASE.sub(" ", name).replace("_", " ").lower()
+
+
+class SchemaIndex:
+    """
+    Retrieval index over the tables and columns of each database in `schema_catalog`.
+    Every column is a document of its table and column names, split into words, the
+    natural names of `app/dev_tables.json` and its descriptions. Documents are embedded
+    with character n-gram TF-IDF, and an NLQ is scored against them with one sparse product.
+    An index is built on first use and rebuilt when the catalog of its database changes.
+    """
+    def __init__(self, catalog: SchemaCatalog, dev_tables_path: str = "dev_tables.json"):
+        self.catalog = catalog
+        self.dev_tables_path = dev_tables_path
+        self.dev_tables = None
+        self.indexes: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def natural_names(self, db_name: str) -> tuple[dict, dict]:
+        """
+        Natural table and column names (and the key columns) of `app/dev_tables.json`, keyed by lowercase original names.
+        """
+        if self.dev_tables is None:
+            path = pkg_resources.files("app").joinpath(self.dev_tables_path)
+            self.dev_tables = {}
+            if path.is_file():
+                with path.open("r") as file:
+                    self.dev_tables = {schema["db_id"]: schema for schema in json.load(file)}
+        schema = self.dev_tables.get(db_name)
+        if schema is None:
+            return {}, {}
+        tables = {
+            original.lower(): name
+            for original, name in zip(schema["table_names_original"], schema["table_names"])
+        }
+        keys = set()
+        for key in schema["primary_keys"]:
+            keys.update(key if isinstance(key, list) else [key])
+        for pair in schema["foreign_keys"]:
+            keys.update(pair)
+        columns = {}
+        for idx, ((table_idx, original), (_, name)) in enumerate(
+            zip(schema["column_names_original"], schema["column_names"])
+        ):
+            if table_idx >= 0:
+                table = schema["table_names_original"][table_idx].lower()
+                columns[table, original.lower()] = (name, idx in keys)
+        return tables, columns
+
+    def build(self, db_name: str, tables: dict[str, TableDescription]) -> dict:
+        natural_tables, natural_columns = self.natural_names(db_name)
+        # Tables without columns have nothing to match
+        tables = [table for table in tables.values() if table.columns]
+        documents, is_key, starts = [], [], []
+        for table in tables:
+            starts.append(len(documents))
+            table_words = f"{identifier_words(table.name)} {natural_tables.get(table.name.lower(), '')}"
+            for column in table.columns:
+                natural_name, key = natural_columns.get((table.name.lower(), column.name.lower()), ("", False))
+                documents.append(" ".join(
+                    value for value in (
+                        table_words, identifier_words(column.name), natural_name,
+                        column.description, column.value_description,
+                    )
+                    if value and value != "nan"
+                ))
+                is_key.append(key)
+        vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 4), sublinear_tf=True, lowercase=True)
+        matrix = vectorizer.fit_transform(documents)
+        return {
+            "analyzer": vectorizer.build_analyzer(),
+            "vocabulary": vectorizer.vocabulary_,
+            "idf": vectorizer.idf_,
+            # Features x columns, so an NLQ only touches the rows of its n-grams
+            "matrix": matrix.T.tocsr(),
+            # The columns of a table are contiguous, starting at its offset
+            "starts": np.array(starts),
+            "is_key": np.array(is_key, dtype=bool),
+            "tables": tables,
+        }
+
+    def get_index(self, db_name: str) -> dict:
+        tables = self.catalog.get_tables(db_name)
+        signature = tuple((table.name, table.mtime) for table in tables.values())
+        with self.lock:
+            cached = self.indexes.get(db_name)
+            if cached is None or cached["signature"] != signature:
+                cached = {**self.build(db_name, tables), "signature": signature}
+                self.indexes[db_name] = cached
+            return cached
+
+    def warm(self):
+        for db_name in self.catalog.databases():
+            self.get_index(db_name)
+
+    def key_columns(self, db_name: str) -> frozenset:
+        """
+        (table, column) pairs of the primary and foreign key columns of a database.
+        """
+        index = self.get_index(db_name)
+        starts = np.append(index["starts"], len(index["is_key"]))
+        return frozenset(
+            (table.name, table.columns[position].name)
+            for table, start, end in zip(index["tables"], starts[:-1], starts[1:])
+            for position in np.flatnonzero(index["is_key"][start:end])
+        )
+
+    @staticmethod
+    def score(index: dict, nlq: str) -> np.ndarray:
+        """
+        Cosine similarity of the NLQ to every column document. Same weighting as
+        `TfidfVectorizer.transform`, without its per-call input validation.
+        """
+        counts = Counter(index["analyzer"](nlq))
+        features = [(index["vocabulary"].get(gram), count) for gram, count in counts.items()]
+        features = [(feature, count) for feature, count in features if feature is not None]
+        if not features:
+            return np.zeros(index["matrix"].shape[1])
+        ids = np.array([feature for feature, _ in features])
+        weights = (1 + np.log([count for _, count in features])) * index["idf"][ids]
+        weights /= np.linalg.norm(weights)
+        return index["matrix"][ids].T @ weights
+
+    def shortlist(
+        self,
+        db_name: str,
+        nlq: str,
+        top_tables: Optional[int] = None,
+        top_columns: Optional[int] = None,
+        tables: Optional[list[str]] = None,
+    ) -> dict[str, list[tuple[ColumnDescription, float]]]:
+        """
+        The tables of a database most relevant to the NLQ, each with its most relevant columns.
+
+        Args:
+            db_name (str): The name of the database.
+            nlq (str): The natural language query.
+            top_tables (int): Tables to keep, SCHEMA_INDEX_TOP_TABLES (default 5).
+            top_columns (int): Columns to keep per table, SCHEMA_INDEX_TOP_COLUMNS (default 10).
+                Key columns of the kept tables are always included.
+            tables (list[str]): Only rank the columns of these tables.
+
+        Returns:
+            dict: (column, score) pairs per table in schema order, most relevant table first.
+        """
+        top_tables = top_tables or int(os.getenv("SCHEMA_INDEX_TOP_TABLES", "5"))
+        top_columns = top_columns or int(os.getenv("SCHEMA_INDEX_TOP_COLUMNS", "10"))
+        index = self.get_index(db_name)
+        catalog = index["tables"]
+        missing = set(tables or []) - {table.name for table in catalog}
+        if missing:
+            raise FileNotFoundError(f"Tables not found in database {db_name}: {', '.join(sorted(missing))}")
+        scores = self.score(index, nlq)
+        starts = index["starts"]
+        ends = np.append(starts[1:], len(scores))
+
+        # A table is as relevant as its best column, ties broken by how many columns match
+        order = np.lexsort((-np.add.reduceat(scores, starts), -np.maximum.reduceat(scores, starts)))
+        if tables is None:
+            order = order[:top_tables]
+        else:
+            order = [i for i in order if catalog[i].name in tables]
+
+        shortlist = {}
+        for i in order:
+            table_scores = scores[starts[i]:ends[i]]
+            keep = index["is_key"][starts[i]:ends[i]].copy()
+            if len(table_scores) > top_columns:
+                keep[np.argpartition(-table_scores, top_columns - 1)[:top_columns]] = True
+            else:
+                keep[:] = True
+            shortlist[catalog[i].name] = [
+                (catalog[i].columns[position], float(table_scores[position]))
+                for position in np.flatnonzero(keep)
+            ]
+        return shortlist
+
+
+schema_index = SchemaIndex(schema_catalog)
+
+
+DATA_FORMATS = {"integer": "int", "datetime": "datetime", "date": "date", "real": "real", "text": "text"}
+# Description values that carry no information
+EMPTY_DESCRIPTIONS = {"", "nan", "none", "null", "not useful", "data_format"}
+
+
+def description_text(value: str) -> str:
+    """
+    A description on one line, empty if it carries no information.
+    """
+    value = " ".join(value.split())
+    return "" if value.lower() in EMPTY_DESCRIPTIONS else value
+
+
+def compact_schema(
+    tables: dict[str, list[tuple[ColumnDescription, float]]],
+    count_tokens: Callable[[str], int],
+    budget: Optional[int] = None,
+    keys: frozenset = frozenset(),
+) -> tuple[str, dict]:
+    """
+    Renders shortlisted tables (see `SchemaIndex.shortlist`) as compact prompt text that fits
+    `budget` tokens. Empty descriptions are dropped, data formats abbreviated, descriptions repeating
+    the column name or an earlier column left out, and if the text is still over budget the least
+    relevant columns are removed, columns of more relevant tables last. Table headers and the `keys`
+    (table, column) pairs are always kept, so a budget too small for them is exceeded and reported
+    as `over_budget` tokens.
+
+    Returns:
+        tuple[str, dict]: The text and its token counts before and after compaction.
+    """
+    lines = {}
+    seen = {}
+    for table, columns in tables.items():
+        for position, (column, _) in enumerate(columns):
+            data_format = column.data_format.strip().lower()
+            data_format = DATA_FORMATS.get(data_format, "" if data_format in EMPTY_DESCRIPTIONS else data_format)
+            name = column.name.strip()
+            line = f"- {name}" + (f" ({data_format})" if data_format else "")
+            description = description_text(column.description)
+            if description and description.lower() != identifier_words(name):
+                line += f": {description}"
+            value_description = description_text(column.value_description)
+            if value_description and value_description != description:
+                if value_description in seen:
+                    line += f"; values: same as {seen[value_description]}"
+                else:
+                    seen[value_description] = f"{table}.{name}"
+                    line += f"; values: {value_description}"
+            lines[table, position] = line
+
+    def render(kept) -> str:
+        return "\n\n".join(
+            f"Table: {table}" + "".join("\n" + lines[table, position] for position in positions)
+            for table, positions in kept.items()
+        )
+
+    kept = {table: list(range(len(columns))) for table, columns in tables.items()}
+    text = render(kept)
+    tokens = count_tokens(text)
+    dropped = 0
+    if budget is not None and tokens > budget:
+        line_tokens = {key: count_tokens(line) + 1 for key, line in lines.items()}
+        # Popped least relevant first: lowest score, then columns of less relevant tables
+        # and later columns. Key columns are never removed
+        removable = sorted(
+            (
+                (-score, rank, position, table)
+                for rank, (table, columns) in enumerate(tables.items())
+                for position, (column, score) in enumerate(columns)
+                if (table, column.name) not in keys
+            ),
+        )
+        estimate = tokens
+        while tokens > budget and removable:
+            *_, position, table = removable.pop()
+            kept[table].remove(position)
+            estimate -= line_tokens[table, position]
+            dropped += 1
+            # Line counts only approximate the rendered text, so recount once they fit
+            if estimate <= budget or not removable:
+                text = render(kept)
+                tokens = estimate = count_tokens(text)
+
+    verbose = "\n\n".join(
+        SchemaCatalog.format_columns(table, [column for column, _ in columns]) for table, columns in tables.items()
+    )
+    return text, {
+        "before": count_tokens(verbose),
+        "after": tokens,
+        "budget": budget,
+        "dropped_columns": dropped,
+        "over_budget": max(tokens - budget, 0) if budget is not None else 0,
+    }
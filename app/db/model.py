@@ -1,11 +1,32 @@
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Optional
 
 class DBRequest(BaseModel):
     sql: str
+    db_id: Optional[str] = None
+    max_rows: Optional[int] = None
+    max_bytes: Optional[int] = None
+    stream: bool = False
+    cache: bool = True
+
+class InvalidateCacheRequest(BaseModel):
+    db_id: Optional[str] = None
 
 class ErrorModel(BaseModel):
     error: str
 
 class SuccessResponse(BaseModel):
-    value: Any
\ No newline at end of file
+    value: Any
+    columns: list[str] = []
+    rows: list[Any] = []
+    row_count: int = 0
+    truncated: bool = False
+    cached: bool = False
+
+    @classmethod
+    def from_result(cls, result: dict) -> "SuccessResponse":
+        """
+        Wraps a `DBEngine.fetch_postgresql_query` result; `value` keeps the first cell.
+        """
+        rows = result["rows"]
+        return cls(value=rows[0][0] if rows and rows[0] else None, **result)
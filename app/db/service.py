@@ -1,25 +1,466 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from typing import Iterator, Optional
+import json
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import uuid
 import psycopg2
+from psycopg2 import extensions, pool
+from pydantic import BaseModel
 
-class DBEngine:
-    def connect_postgresql(self):
-        # Open database connection
-        # Connect to the database
-        db = psycopg2.connect(
-            "dbname=bird user=nlidb host=localhost password='' port=5432"
+
+class ConnectionPools:
+    """
+    One psycopg2 connection pool per BIRD database, created on first use.
+    Connection settings come from the environment:
+    PG_HOST, PG_PORT, PG_USER, PG_PASSWORD, PG_DEFAULT_DB,
+    PG_POOL_MIN, PG_POOL_MAX and PG_POOL_HEALTH_CHECK_INTERVAL (seconds).
+    """
+    def __init__(self):
+        self.pools: dict[str, pool.ThreadedConnectionPool] = {}
+        # ThreadedConnectionPool raises instead of waiting when it is exhausted
+        self.slots: dict[str, threading.BoundedSemaphore] = {}
+        self.last_used: dict[int, float] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def settings() -> dict:
+        return {
+            "host": os.getenv("PG_HOST", "localhost"),
+            "port": int(os.getenv("PG_PORT", "5432")),
+            "user": os.getenv("PG_USER", "nlidb"),
+            "password": os.getenv("PG_PASSWORD", ""),
+        }
+
+    @staticmethod
+    def default_db() -> str:
+        return os.getenv("PG_DEFAULT_DB", "bird")
+
+    def get_pool(self, db_id: str) -> tuple[pool.ThreadedConnectionPool, threading.BoundedSemaphore]:
+        with self.lock:
+            if db_id not in self.pools:
+                minconn = int(os.getenv("PG_POOL_MIN", "1"))
+                maxconn = int(os.getenv("PG_POOL_MAX", "8"))
+                self.pools[db_id] = pool.ThreadedConnectionPool(
+                    minconn, maxconn, dbname=db_id, **self.settings()
+                )
+                self.slots[db_id] = threading.BoundedSemaphore(maxconn)
+            return self.pools[db_id], self.slots[db_id]
+
+    def is_healthy(self, conn) -> bool:
+        if conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        interval = float(os.getenv("PG_POOL_HEALTH_CHECK_INTERVAL", "30"))
+        if time.monotonic() - self.last_used.get(id(conn), 0) < interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self, db_id: Optional[str] = None):
+        """
+        Borrows a healthy connection to `db_id` and rolls back any open transaction on return.
+        """
+        db_id = db_id or self.default_db()
+        connection_pool, slots = self.get_pool(db_id)
+        with slots:
+            conn = connection_pool.getconn()
+            while not self.is_healthy(conn):
+                self.last_used.pop(id(conn), None)
+                connection_pool.putconn(conn, close=True)
+                conn = connection_pool.getconn()
+
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                if not broken and not conn.closed:
+                    conn.rollback()
+                    self.last_used[id(conn)] = time.monotonic()
+                else:
+                    self.last_used.pop(id(conn), None)
+                connection_pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def close(self):
+        with self.lock:
+            for connection_pool in self.pools.values():
+                connection_pool.closeall()
+            self.pools.clear()
+            self.slots.clear()
+            self.last_used.clear()
+
+
+connection_pools = ConnectionPools()
+
+# Statements that can be wrapped in DECLARE ... CURSOR FOR
+DECLARABLE_QUERY = re.compile(r"^[\s(]*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+# String literals and quoted identifiers, whose whitespace is significant
+QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Collapses whitespace outside quotes and strips trailing semicolons,
+    so that formatting-only differences map to the same cache entry.
+    """
+    parts = QUOTED.split(query.strip().rstrip(";").strip())
+    # Odd parts are the quoted ones
+    return "".join(
+        part if index % 2 else WHITESPACE.sub(" ", part)
+        for index, part in enumerate(parts)
+    )
+
+
+class QueryResultCache:
+    """
+    Caches complete (untruncated) results of SELECT-like queries keyed by (database, normalized SQL).
+
+    Results live in an in-memory LRU bounded by QUERY_CACHE_MAX_ENTRIES and QUERY_CACHE_MAX_BYTES
+    (approximate result size), and, when QUERY_CACHE_PATH is set, in a SQLite file that survives
+    restarts. The file also holds a version per database: `invalidate` (also run by db/migrate.py
+    after reloading a database) bumps it, and other processes drop their in-memory entries for the
+    database within QUERY_CACHE_VERSION_CHECK_INTERVAL seconds. QUERY_CACHE_ENABLED=false turns it off.
+    """
+    def __init__(self):
+        # (db_id, sql) -> (version, result, size)
+        self.entries: OrderedDict[tuple[str, str], tuple[int, dict, int]] = OrderedDict()
+        self.size = 0
+        self.versions: dict[str, int] = {}
+        self.versions_checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.initialized_path = None
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.getenv("QUERY_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+
+    @staticmethod
+    def limits() -> tuple[int, int]:
+        return (
+            int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1024")),
+            int(os.getenv("QUERY_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
         )
-        return db
+
+    def connect(self) -> Optional[sqlite3.Connection]:
+        path = os.getenv("QUERY_CACHE_PATH")
+        if not path:
+            return None
+        conn = sqlite3.connect(path, timeout=30)
+        # The tables are created on the first connection to a path only
+        if self.initialized_path != path:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_results ("
+                    "db_id TEXT, sql_hash TEXT, version INTEGER, result BLOB, PRIMARY KEY (db_id, sql_hash))"
+                )
+                conn.execute("CREATE TABLE IF NOT EXISTS db_versions (db_id TEXT PRIMARY KEY, version INTEGER)")
+            self.initialized_path = path
+        return conn
+
+    @staticmethod
+    def sql_hash(query: str) -> str:
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def version(self, db_id: str) -> int:
+        interval = float(os.getenv("QUERY_CACHE_VERSION_CHECK_INTERVAL", "5"))
+        if time.monotonic() - self.versions_checked >= interval:
+            conn = self.connect()
+            if conn is not None:
+                with conn:
+                    self.versions = dict(conn.execute("SELECT db_id, version FROM db_versions"))
+                conn.close()
+            self.versions_checked = time.monotonic()
+        return self.versions.get(db_id, 0)
+
+    def get(self, db_id: str, query: str, max_rows: int, max_bytes: int) -> Optional[dict]:
+        """
+        Returns the cached result capped to `max_rows` / `max_bytes`, or None on a miss.
+        """
+        if not self.enabled() or not DECLARABLE_QUERY.match(query):
+            return None
+        query = normalize_sql(query)
+        with self.lock:
+            version = self.version(db_id)
+            entry = self.entries.get((db_id, query))
+            if entry is not None and entry[0] != version:
+                self.discard((db_id, query))
+                entry = None
+            if entry is None:
+                entry = self.load(db_id, query, version)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((db_id, query))
+            self.hits += 1
+        _, result, size = entry
+        if size > max_bytes:
+            # Let the query run again and truncate at the byte cap
+            return None
+        rows = result["rows"][:max_rows]
+        return {
+            **result,
+            "rows": rows,
+            "row_count": len(rows),
+            "truncated": len(rows) < result["row_count"],
+            "cached": True,
+        }
+
+    def load(self, db_id: str, query: str, version: int) -> Optional[tuple[int, dict, int]]:
+        conn = self.connect()
+        if conn is None:
+            return None
+        with conn:
+            row = conn.execute(
+                "SELECT result FROM query_results WHERE db_id = ? AND sql_hash = ? AND version = ?",
+                (db_id, self.sql_hash(query), version),
+            ).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        result = pickle.loads(row[0])
+        return self.remember(db_id, query, version, result, len(row[0]))
+
+    def put(self, db_id: str, query: str, result: dict):
+        """
+        Stores a result unless it was truncated or the query is not SELECT-like.
+        """
+        if not self.enabled() or result["truncated"] or not DECLARABLE_QUERY.match(query):
+            return
+        query = normalize_sql(query)
+        blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            version = self.version(db_id)
+            self.remember(db_id, query, version, result, len(blob))
+            conn = self.connect() if len(blob) <= self.limits()[1] else None
+            if conn is not None:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO query_results VALUES (?, ?, ?, ?)",
+                        (db_id, self.sql_hash(query), version, blob),
+                    )
+                conn.close()
+
+    def remember(self, db_id: str, query: str, version: int, result: dict, size: int) -> tuple[int, dict, int]:
+        max_entries, max_bytes = self.limits()
+        entry = (version, result, size)
+        if size > max_bytes:
+            return entry
+        self.discard((db_id, query))
+        self.entries[(db_id, query)] = entry
+        self.size += size
+        while len(self.entries) > max_entries or self.size > max_bytes:
+            self.discard(next(iter(self.entries)))
+        return entry
+
+    def discard(self, key: tuple[str, str]):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate(self, db_id: Optional[str] = None):
+        """
+        Drops the cached results of `db_id`, or of every database.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if db_id is None or key[0] == db_id]:
+                self.discard(key)
+            conn = self.connect()
+            if conn is None:
+                return
+            with conn:
+                if db_id is None:
+                    conn.execute("DELETE FROM query_results")
+                    conn.execute("UPDATE db_versions SET version = version + 1")
+                else:
+                    conn.execute("DELETE FROM query_results WHERE db_id = ?", (db_id,))
+                    conn.execute(
+                        "INSERT INTO db_versions VALUES (?, 1) "
+                        "ON CONFLICT (db_id) DO UPDATE SET version = version + 1",
+                        (db_id,),
+                    )
+            conn.close()
+            self.versions_checked = 0.0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "persistent": bool(os.getenv("QUERY_CACHE_PATH")),
+            }
+
+
+query_cache = QueryResultCache()
+
+
+def json_default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, memoryview):
+        return value.hex()
+    return str(value)
+
+
+def encode_event(event: str, data: dict, format: str) -> str:
+    """
+    Encodes one streamed event as a server-sent event (`format` "sse") or an NDJSON line.
+    """
+    payload = json.dumps(data, default=json_default)
+    if format == "sse":
+        return f"event: {event}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+def ndjson_lines(columns: list[str], batches: Iterator, max_rows: Optional[int] = None) -> Iterator[str]:
+    """
+    Encodes a streamed result as NDJSON: a `columns` header line, one JSON array per row,
+    and a trailer line with the `row_count` and whether the result was `truncated`.
+    Errors raised while streaming are reported as a final `error` line.
+    """
+    row_count = 0
+    truncated = False
+    try:
+        yield json.dumps({"columns": columns}) + "\n"
+        for batch in batches:
+            if max_rows is not None and row_count + len(batch) > max_rows:
+                batch = batch[:max_rows - row_count]
+                truncated = True
+            if batch:
+                yield "".join(json.dumps(row, default=json_default) + "\n" for row in batch)
+                row_count += len(batch)
+            if truncated:
+                break
+        yield json.dumps({"row_count": row_count, "truncated": truncated}) + "\n"
+    except Exception as e:
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        batches.close()
+
+
+class DBEngine:
+    def __init__(self, pools: ConnectionPools = connection_pools):
+        self.pools = pools
+
+    def connect_postgresql(self, db_id: Optional[str] = None):
+        # Borrow a pooled connection to the database
+        return self.pools.connection(db_id)
 
 
     def execute_postgresql_query(self, cursor, query):
-        """Execute a MySQL query."""
+        """Execute a PostgreSQL query."""
         cursor.execute(query)
         result = cursor.fetchall()
         return result
 
 
-    def perform_query_on_postgresql_databases(self, query):
-        db = self.connect_postgresql()
-        cursor = db.cursor()
-        result = self.execute_postgresql_query(cursor, query)
-        db.close()
-        return result
\ No newline at end of file
+    def perform_query_on_postgresql_databases(self, query, db_id: Optional[str] = None):
+        with self.connect_postgresql(db_id) as db:
+            with db.cursor() as cursor:
+                return self.execute_postgresql_query(cursor, query)
+
+
+    @staticmethod
+    def fetch_limits(max_rows: Optional[int] = None, max_bytes: Optional[int] = None) -> tuple[int, int]:
+        return (
+            max_rows if max_rows is not None else int(os.getenv("DB_MAX_ROWS", "10000")),
+            max_bytes if max_bytes is not None else int(os.getenv("DB_MAX_BYTES", str(16 * 1024 * 1024))),
+        )
+
+    def stream_postgresql_query(self, query, db_id: Optional[str] = None, batch_size: Optional[int] = None) -> Iterator:
+        """
+        Executes a query and yields its column names, then its rows in batches.
+        SELECT-like queries run on a server-side cursor so only one batch is held in memory;
+        the pooled connection stays borrowed until the generator is exhausted or closed.
+
+        Args:
+            query (str): The SQL query.
+            db_id (str): The database to run the query on.
+            batch_size (int): Rows per `fetchmany` call, defaults to DB_FETCH_BATCH_SIZE.
+
+        Yields:
+            list[str] first, then lists of row tuples.
+        """
+        batch_size = batch_size or int(os.getenv("DB_FETCH_BATCH_SIZE", "1000"))
+        with self.connect_postgresql(db_id) as db:
+            if DECLARABLE_QUERY.match(query):
+                cursor = db.cursor(name=f"nlidb_{uuid.uuid4().hex}")
+                query = query.strip().rstrip(";")
+            else:
+                cursor = db.cursor()
+            with cursor:
+                cursor.execute(query)
+                if not cursor.name and cursor.description is None:
+                    # Statement without a result set
+                    yield []
+                    return
+                # Named cursors only expose their description after the first fetch
+                batch = cursor.fetchmany(batch_size)
+                yield [column.name for column in cursor.description or []]
+                while batch:
+                    yield batch
+                    if len(batch) < batch_size:
+                        break
+                    batch = cursor.fetchmany(batch_size)
+
+    def fetch_postgresql_query(
+        self,
+        query,
+        db_id: Optional[str] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> dict:
+        """
+        Executes a query and collects its rows up to the row and (approximate) byte caps.
+
+        Returns:
+            dict: `columns`, `rows`, `row_count` and whether the result was `truncated`.
+        """
+        max_rows, max_bytes = self.fetch_limits(max_rows, max_bytes)
+        stream = self.stream_postgresql_query(query, db_id)
+        try:
+            columns = next(stream)
+            rows = []
+            size = 0
+            truncated = False
+            for batch in stream:
+                for row in batch:
+                    size += len(repr(row))
+                    if len(rows) >= max_rows or size > max_bytes:
+                        truncated = True
+                        break
+                    rows.append(row)
+                if truncated:
+                    break
+        finally:
+            stream.close()
+        return {
+            "columns": columns,
+            "rows": rows,
+            "row_count": len(rows),
+            "truncated": truncated,
+        }
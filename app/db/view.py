@@ -1,20 +1,44 @@
 from fastapi import APIRouter, HTTPException
-from app.db.model import DBRequest, ErrorModel, SuccessResponse
+from fastapi.responses import StreamingResponse
+from app.db.model import DBRequest, ErrorModel, InvalidateCacheRequest, SuccessResponse
 from app.db import router
-from app.db.service import DBEngine
+from app.db.service import query_cache
+from app.generation.service import pipeline
+import asyncio
 
 
 
 @router.post("/execute")
 async def execute_query(request: DBRequest):
     """
-    API endpoint to execute a given nlq
+    API endpoint to execute a given nlq.
+    Returns the (capped) result set, or streams it as NDJSON when `stream` is set.
     """
-    db_engine = DBEngine()
-
     try:
-        exec_result = db_engine.perform_query_on_postgresql_databases(request.sql)
+        if request.stream:
+            lines = await pipeline.stream(request.sql, request.db_id, request.max_rows)
+            return StreamingResponse(lines, media_type="application/x-ndjson")
+        exec_result = await pipeline.execute(
+            request.sql, request.db_id, request.max_rows, request.max_bytes, request.cache
+        )
     except Exception as e:
         return ErrorModel(error=str(e))
 
-    return SuccessResponse(value=exec_result[0][0])
\ No newline at end of file
+    return SuccessResponse.from_result(exec_result)
+
+
+@router.get("/cache")
+async def cache_stats():
+    """
+    Returns the query result cache statistics.
+    """
+    return query_cache.stats()
+
+
+@router.post("/cache/invalidate")
+async def invalidate_cache(request: InvalidateCacheRequest):
+    """
+    Drops the cached query results of a database, or of all databases when `db_id` is not given.
+    """
+    await asyncio.to_thread(query_cache.invalidate, request.db_id)
+    return query_cache.stats()
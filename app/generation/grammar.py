@@ -0,0 +1,239 @@
+"""
+GBNF grammars for SQL restricted to the tables and columns of one BIRD database.
+"""
+
+from typing import Optional
+from pathlib import Path
+import importlib.resources as pkg_resources
+import json
+import os
+import re
+import sys
+import threading
+
+PROCESSED_TABLES_PATH = Path(__file__).resolve().parents[2] / "data" / "bird" / "processed_tables.json"
+
+SIMPLE_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+# Names that must be quoted to be read as identifiers
+RESERVED = {
+    "ALL", "AND", "ANY", "AS", "ASC", "BETWEEN", "BY", "CASE", "CAST", "CHECK", "COLUMN",
+    "CONSTRAINT", "CREATE", "DEFAULT", "DESC", "DISTINCT", "DO", "ELSE", "END", "EXCEPT",
+    "FALSE", "FOR", "FOREIGN", "FROM", "GRANT", "GROUP", "HAVING", "IN", "INNER", "INTERSECT",
+    "INTO", "IS", "JOIN", "LEFT", "LIKE", "LIMIT", "NOT", "NULL", "OFFSET", "ON", "OR", "ORDER",
+    "PRIMARY", "REFERENCES", "RIGHT", "SELECT", "TABLE", "THEN", "TO", "TRUE", "UNION", "UNIQUE",
+    "USER", "USING", "WHEN", "WHERE", "WITH",
+}
+
+FUNCTIONS = [
+    "COUNT", "SUM", "AVG", "MIN", "MAX", "ROUND", "ABS", "CEIL", "FLOOR", "POWER", "SQRT",
+    "LENGTH", "UPPER", "LOWER", "TRIM", "SUBSTR", "SUBSTRING", "REPLACE", "CONCAT", "STRPOS",
+    "SPLIT_PART", "LEFT", "RIGHT", "NULLIF", "COALESCE", "GREATEST", "LEAST", "TO_CHAR",
+    "TO_DATE", "TO_NUMBER", "DATE", "DATE_PART", "DATE_TRUNC", "AGE", "NOW", "RANK",
+    "DENSE_RANK", "ROW_NUMBER",
+]
+
+TYPES = [
+    "REAL", "FLOAT", "DOUBLE PRECISION", "NUMERIC", "DECIMAL", "INTEGER", "INT", "BIGINT",
+    "TEXT", "VARCHAR", "DATE", "TIMESTAMP", "TIME", "INTERVAL",
+]
+
+DATE_FIELDS = ["YEAR", "MONTH", "DAY", "HOUR", "MINUTE", "SECOND", "EPOCH", "DOW", "DOY"]
+
+# Every rule on a single line, as in the other grammars of `grammars/`
+SQL_RULES = """
+query ::= (with-clause sp)? select (sp set-op sp select)*
+with-clause ::= "WITH" sp ("RECURSIVE" sp)? cte (ws "," ws cte)*
+cte ::= cte-name sp "AS" ws "(" ws query ws ")"
+cte-name ::= "cte" [a-zA-Z0-9_]*
+set-op ::= "UNION ALL" | "UNION" | "INTERSECT" | "EXCEPT"
+select ::= "SELECT" sp ("DISTINCT" (sp "ON" ws "(" ws expr-list ws ")")? sp)? select-list (sp "FROM" sp from-list (sp join)*)? (sp "WHERE" sp condition)? (sp "GROUP BY" sp expr-list)? (sp "HAVING" sp condition)? (sp "ORDER BY" sp order-list)? (sp "LIMIT" sp integer)? (sp "OFFSET" sp integer)?
+select-list ::= select-item (ws "," ws select-item)*
+select-item ::= "*" | alias ".*" | expr (sp ("AS" sp)? label)?
+from-list ::= from-item (ws "," ws from-item)*
+from-item ::= (table | cte-name | "(" ws query ws ")") (sp ("AS" sp)? alias)?
+join ::= (("INNER" | "LEFT" | "RIGHT" | "FULL") sp ("OUTER" sp)?)? "JOIN" sp from-item sp "ON" sp condition
+condition ::= condition-term (sp ("AND" | "OR") sp condition-term)*
+condition-term ::= ("NOT" sp)? predicate
+predicate ::= expr (ws comparison ws expr | sp "IS" sp ("NOT" sp)? "NULL" | sp ("NOT" sp)? ("LIKE" | "ILIKE") sp expr | sp ("NOT" sp)? "BETWEEN" sp expr sp "AND" sp expr | sp ("NOT" sp)? "IN" ws "(" ws (query | expr-list) ws ")")? | "EXISTS" ws "(" ws query ws ")" | "(" ws condition ws ")"
+comparison ::= "=" | "<>" | "!=" | "<=" | ">=" | "<" | ">"
+expr-list ::= expr (ws "," ws expr)*
+expr ::= unary (ws operator ws unary)*
+operator ::= "+" | "-" | "*" | "/" | "%" | "||"
+unary ::= "-"? primary (ws "::" ws type)?
+primary ::= column-ref | literal | function | cast | extract | case | "(" ws expr ws ")" | "(" ws query ws ")"
+function ::= function-name ws "(" ws ("*" | ("DISTINCT" sp)? expr-list)? ws ")" (sp "OVER" ws "(" ws window ws ")")?
+window ::= ("PARTITION BY" sp expr-list)? (ws "ORDER BY" sp order-list)?
+cast ::= "CAST" ws "(" ws expr sp "AS" sp type ws ")"
+extract ::= "EXTRACT" ws "(" ws date-field sp "FROM" sp expr ws ")"
+case ::= "CASE" (sp expr)? (sp "WHEN" sp condition sp "THEN" sp expr)+ (sp "ELSE" sp expr)? sp "END"
+order-list ::= order-item (ws "," ws order-item)*
+order-item ::= (expr | label) (sp ("ASC" | "DESC"))? (sp "NULLS" sp ("FIRST" | "LAST"))?
+literal ::= string | number | "NULL" | "TRUE" | "FALSE" | "CURRENT_DATE" | "CURRENT_TIMESTAMP" | ("INTERVAL" | "DATE" | "TIMESTAMP") sp string
+string ::= "'" ("''" | [^'"\\\\\\x00-\\x1F])* "'"
+number ::= [0-9]+ ("." [0-9]+)?
+integer ::= [0-9]+
+alias ::= [a-zA-Z_] [a-zA-Z0-9_]*
+label ::= [a-zA-Z_] [a-zA-Z0-9_]* | quote [^"\\\\\\x00-\\x1F]+ quote
+sp ::= " "
+ws ::= " "?
+"""
+
+
+def gbnf_literal(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def alternatives(options: list[str]) -> str:
+    # Keywords in upper or lower case
+    return " | ".join(gbnf_literal(variant) for option in options for variant in (option, option.lower()))
+
+
+def case_insensitive(name: str) -> str:
+    return " ".join(
+        f"[{char.upper()}{char.lower()}]" if char.isalpha() else gbnf_literal(char) for char in name
+    )
+
+
+class SchemaGrammar:
+    """
+    Generates GBNF grammars for SQL whose table and column names are restricted to the
+    real names of a database, read from `app/dev_tables.json` and, for databases it lacks,
+    `data/bird/processed_tables.json`. Names that are not plain identifiers are double-quoted.
+    Columns are only referenced by their real names, so labels of derived tables and CTEs
+    cannot be referenced from the outer query; ORDER BY may also name a select label.
+    CTE names must start with "cte" so they cannot be mistaken for made-up tables.
+    When linking selects tables, only those are allowed: a table it missed cannot be
+    generated, so a linking miss becomes a wrong query rather than a retry.
+    The grammar accepts the SQL alone or the `{"final_query": ...}` JSON object of a response
+    format whose only required field is `final_query` (SQL_RESPONSE_LAYOUT "final_first" or
+    "final_only"). SCHEMA_GRAMMAR_ENABLED=false turns it off for local models.
+    """
+    def __init__(self, dev_tables_path: str = "dev_tables.json", processed_tables_path: Path = PROCESSED_TABLES_PATH):
+        self.dev_tables_path = dev_tables_path
+        self.processed_tables_path = processed_tables_path
+        self.schemas: Optional[dict[str, dict[str, list[str]]]] = None
+        self.lock = threading.Lock()
+
+    def load(self) -> dict[str, dict[str, list[str]]]:
+        with self.lock:
+            if self.schemas is None:
+                schemas = {}
+                if self.processed_tables_path.is_file():
+                    with self.processed_tables_path.open("r") as file:
+                        schemas.update(json.load(file))
+                path = pkg_resources.files("app").joinpath(self.dev_tables_path)
+                if path.is_file():
+                    with path.open("r") as file:
+                        for schema in json.load(file):
+                            tables = {table: [] for table in schema["table_names_original"]}
+                            for table_idx, column in schema["column_names_original"]:
+                                if table_idx >= 0:
+                                    tables[schema["table_names_original"][table_idx]].append(column)
+                            schemas[schema["db_id"]] = tables
+                self.schemas = schemas
+            return self.schemas
+
+    def schema(self, db_id: str, tables: Optional[list[str]] = None) -> Optional[dict[str, list[str]]]:
+        """
+        Tables and columns of a database, limited to `tables` (matched case-insensitively) if given.
+        """
+        schema = self.load().get(db_id)
+        if schema is None:
+            return None
+        if tables is not None:
+            wanted = {table.lower() for table in tables}
+            schema = {table: columns for table, columns in schema.items() if table.lower() in wanted}
+        return schema or None
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.getenv("SCHEMA_GRAMMAR_ENABLED", "true").lower() not in ("0", "false", "no")
+
+    @staticmethod
+    def accepts(response_format) -> bool:
+        """
+        Whether `{"final_query": ...}` alone is a valid instance of the response format.
+        """
+        if response_format is None or "final_query" not in response_format.model_fields:
+            return False
+        return all(
+            name == "final_query" or not field.is_required()
+            for name, field in response_format.model_fields.items()
+        )
+
+    @staticmethod
+    def identifier(name: str, quote: str) -> str:
+        """
+        Rule body for a table or column name, double-quoted as is. Plain identifiers may also
+        be unquoted, and are then case-insensitive as PostgreSQL folds them.
+        """
+        quoted = " ".join([quote, gbnf_literal(name.replace('"', '""')), quote])
+        if SIMPLE_IDENTIFIER.fullmatch(name) and name.upper() not in RESERVED:
+            return f"{case_insensitive(name)} | {quoted}"
+        return quoted
+
+    def gbnf(self, schema: dict[str, list[str]], json_field: Optional[str] = "final_query") -> str:
+        """
+        Grammar of SQL over the given tables and columns, wrapped in a JSON object with the
+        query as the string value of `json_field` unless it is None.
+        """
+        quote = '"\\\\\\""' if json_field else '"\\""'
+        if json_field:
+            root = f'root ::= "{{" ws {gbnf_literal(json.dumps(json_field))} ws ":" ws "\\"" query ";"? "\\"" ws "}}"'
+        else:
+            root = 'root ::= query ";"?'
+        rules = [
+            root,
+            SQL_RULES.strip(),
+            f"quote ::= {quote}",
+            f"function-name ::= {alternatives(FUNCTIONS)}",
+            f"type ::= {alternatives(TYPES)}",
+            f"date-field ::= {alternatives(DATE_FIELDS)}",
+        ]
+        table_rules, column_rules = [], []
+        for idx, (table, columns) in enumerate(schema.items()):
+            rules.append(f"table-{idx} ::= {self.identifier(table, quote)}")
+            table_rules.append(f"table-{idx}")
+            if columns:
+                identifiers = dict.fromkeys(self.identifier(column, quote) for column in columns)
+                rules.append(f"column-{idx} ::= {' | '.join(identifiers)}")
+                column_rules.append(f"table-{idx} \".\" column-{idx}")
+        names = dict.fromkeys(self.identifier(column, quote) for columns in schema.values() for column in columns)
+        rules.append(f"table ::= {' | '.join(table_rules)}")
+        rules.append(f"column ::= {' | '.join(names)}")
+        rules.append(f"column-ref ::= {' | '.join(column_rules + ['alias \".\" column', 'column'])}")
+        return "\n".join(rules) + "\n"
+
+    def for_database(self, db_id: str, tables: Optional[list[str]] = None, json_field: Optional[str] = "final_query") -> Optional[str]:
+        """
+        Grammar for a database (or some of its tables), None if the database is unknown.
+        """
+        schema = self.schema(db_id, tables)
+        if schema is None:
+            return None
+        return self.gbnf(schema, json_field)
+
+
+schema_grammar = SchemaGrammar()
+
+
+def main(argv: list[str]) -> int:
+    """
+    Prints the grammar of a database: `python -m app.generation.grammar <db_id> [table ...] [--sql]`.
+    """
+    json_field = None if "--sql" in argv else "final_query"
+    args = [arg for arg in argv if arg != "--sql"]
+    if not args:
+        print(main.__doc__.strip())
+        return 1
+    grammar = schema_grammar.for_database(args[0], args[1:] or None, json_field)
+    if grammar is None:
+        print(f"Unknown database or tables: {' '.join(args)}")
+        return 1
+    print(grammar, end="")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel, Field
 from app.prompts.model import ModelChoices
 
@@ -6,6 +6,10 @@ class NLQRequest(BaseModel):
     natural_language_query: str = Field(..., title="The natural language query")
     clarifications: list[str] = Field(..., title="The clarifications to query")
     model: ModelChoices | str = Field(..., title="Type of model")
+    cache: bool = Field(True, title="Serve identical model calls from the response cache")
+    format: Literal["json", "ndjson", "sse"] = Field(
+        "json", title="Return the result at once or stream the pipeline stages and SQL tokens"
+    )
 
 class Step(BaseModel):
     """
@@ -53,6 +57,32 @@ class SQLGenerationResult(BaseModel):
     final_query: str                         # A single syntactically valid SQL statement
 
 
+class SQLGenerationResultFinalFirst(BaseModel):
+    """
+    SQLGenerationResult with `final_query` generated first. The remaining fields are optional,
+    so structured decoding stops as soon as the final query is complete.
+    """
+    final_query: str
+    subqueries: Optional[SQLSubquery] = None
+    candidates: Optional[SQLCandidate] = None
+    reflection: Optional[SQLReflection] = None
+
+
+class SQLFinalQuery(BaseModel):
+    """
+    SQLGenerationResult trimmed to the final query alone.
+    """
+    final_query: str
+
+
+# Response formats of the SQL generation step, selected with SQL_RESPONSE_LAYOUT
+SQL_RESPONSE_LAYOUTS = {
+    "full": SQLGenerationResult,
+    "final_first": SQLGenerationResultFinalFirst,
+    "final_only": SQLFinalQuery,
+}
+
+
 class ExtractTables(BaseModel):
     """
     The response format for extracting the table names as list of strings.
@@ -1,87 +1,1137 @@
-from typing import List, Optional
-from openai import OpenAI
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI, AsyncOpenAI
 from app.prompts import PromptBuilder
-from app.prompts.model import Prompt
+from app.prompts.model import Prompt, ModelChoices
+from app.classification.service import ClassificationBatcher, ClassificationEngine, compact_schema, schema_catalog, schema_index
+from app.db.service import DBEngine, connection_pools, ndjson_lines, query_cache
+from app.generation.model import ExtractTables, ExtractColumns, SQL_RESPONSE_LAYOUTS
+from app.generation.grammar import schema_grammar
 from llama_cpp import Llama
 from llama_cpp.llama import Llama, LlamaGrammar
 from pydantic_gbnf_grammar_generator import generate_gbnf_grammar_and_documentation
 from pydantic import BaseModel
 import importlib.resources as pkg_resources
 from app.constants import SystemPrompts
+from pathlib import Path
+import asyncio
+import hashlib
+import json
 import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+# llama.cpp models are not thread-safe, so local generation is serialized on
+# its own worker thread instead of blocking the event loop.
+llama_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama")
+
+HF_BASE_URL = "https://api-inference.huggingface.co/v1/"
+
+
+def resident_memory() -> Optional[int]:
+    """
+    Returns the resident set size of the current process in bytes, if it can be read.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of inference backends.
+    HTTP clients are created once per endpoint so their connection pools are reused,
+    and GGUF models stay loaded until the local model memory budget forces the
+    least recently used ones out.
+    """
+    def __init__(self, max_events: int = 100):
+        self.clients = {}
+        self.local_models: OrderedDict[str, Llama] = OrderedDict()
+        self.local_model_sizes: dict[str, int] = {}
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        # One lock per model so concurrent first requests load it once, without holding `lock`
+        self.load_locks: dict[str, threading.Lock] = {}
+
+    @staticmethod
+    def memory_budget() -> Optional[int]:
+        # Read on use, the .env file is loaded after this module is imported
+        budget_mb = os.getenv("LOCAL_MODEL_MEMORY_BUDGET_MB")
+        return int(budget_mb) * 1024 * 1024 if budget_mb else None
+
+    def openai_client(self, base_url: Optional[str] = None, api_key: Optional[str] = None, asynchronous: bool = False):
+        """
+        Returns the shared (Async)OpenAI client for an endpoint, creating it on first use.
+        """
+        key = (base_url, api_key, asynchronous)
+        with self.lock:
+            if key not in self.clients:
+                client_class = AsyncOpenAI if asynchronous else OpenAI
+                self.clients[key] = client_class(base_url=base_url, api_key=api_key)
+            return self.clients[key]
+
+    def local_model(self, model: str) -> Llama:
+        """
+        Returns the resident llama.cpp model, loading it and evicting others if needed.
+        The registry lock is only held for bookkeeping, never during the load itself.
+        """
+        with self.lock:
+            if model in self.local_models:
+                self.local_models.move_to_end(model)
+                return self.local_models[model]
+            load_lock = self.load_locks.setdefault(model, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                # Loaded by a concurrent request while this one waited
+                if model in self.local_models:
+                    self.local_models.move_to_end(model)
+                    return self.local_models[model]
+                model_path = pkg_resources.files("app.models").joinpath(model).as_posix()
+                size = os.path.getsize(model_path)
+                self.evict(self.memory_budget(), incoming=size)
+
+            started = time.perf_counter()
+            llama = Llama(
+                model_path=model_path,
+                n_gpu_layers=-1,
+                n_ctx=1024
+                )
+
+            with self.lock:
+                self.local_models[model] = llama
+                self.local_model_sizes[model] = size
+                self.record("load", model, size, seconds=time.perf_counter() - started)
+                # Other models may have been loaded concurrently
+                self.evict(self.memory_budget())
+            return llama
+
+    def evict(self, budget: Optional[int], incoming: int = 0):
+        # Callers hold the lock. In-flight requests keep their own reference, so
+        # the model is only freed once they finish.
+        if budget is None:
+            return
+        while self.local_models and sum(self.local_model_sizes.values()) + incoming > budget:
+            model, _ = self.local_models.popitem(last=False)
+            self.record("evict", model, self.local_model_sizes.pop(model))
+
+    def record(self, event: str, model: str, size: int, **extra):
+        self.events.append({
+            "event": event,
+            "model": model,
+            "bytes": size,
+            "time": time.time(),
+            **extra,
+        })
+        print(f"Model registry: {event} {model} ({size / 1024 / 1024:.0f} MB)")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "local_models": [
+                    {"model": model, "bytes": self.local_model_sizes[model]}
+                    for model in self.local_models
+                ],
+                "local_models_bytes": sum(self.local_model_sizes.values()),
+                "memory_budget_bytes": self.memory_budget(),
+                "resident_memory_bytes": resident_memory(),
+                "clients": len(self.clients),
+                "events": list(self.events),
+            }
+
+
+model_registry = ModelRegistry()
+
+# Roughly one token per short word piece or punctuation mark
+TOKEN_ESTIMATE = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+class TokenCounter:
+    """
+    Counts prompt tokens for a model: with the llama.cpp tokenizer of local GGUF models,
+    with tiktoken for OpenAI models when it is installed, and with an estimate otherwise.
+    """
+    def __init__(self):
+        self.encodings = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate(text: str) -> int:
+        return len(TOKEN_ESTIMATE.findall(text))
+
+    def encoding(self, model: str):
+        with self.lock:
+            if model not in self.encodings:
+                try:
+                    import tiktoken
+                    try:
+                        self.encodings[model] = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        self.encodings[model] = tiktoken.get_encoding("o200k_base")
+                except ImportError:
+                    self.encodings[model] = None
+            return self.encodings[model]
+
+    def counter(self, model: str) -> Callable[[str], int]:
+        """
+        Returns the token counting function of a model.
+        """
+        if "local" in model:
+            llama = model_registry.local_model(model)
+            return lambda text: len(llama.tokenize(text.encode(), add_bos=False, special=True))
+        if "gpt" in model:
+            encoding = self.encoding(model)
+            if encoding is not None:
+                return lambda text: len(encoding.encode(text))
+        return self.estimate
+
+    @staticmethod
+    def context_window(model: str) -> Optional[int]:
+        """
+        Context size of a local model, None for remote models.
+        """
+        if "local" in model:
+            return model_registry.local_model(model).n_ctx()
+        return None
+
+
+token_counter = TokenCounter()
+
+
+class GrammarCache:
+    """
+    Compiled GBNF grammars shared across requests, the least recently used evicted beyond
+    GRAMMAR_CACHE_MAX_ENTRIES (default 256).
+    Grammars generated from a response format are keyed by the hash of its JSON schema,
+    schema-specialized SQL grammars by the hash of their text and grammars read from
+    the `grammars/` directory by file name and modification time.
+    """
+    grammar_dir = Path(__file__).resolve().parents[2] / "grammars"
+
+    def __init__(self):
+        self.grammars: OrderedDict[str, LlamaGrammar] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def max_entries() -> int:
+        return int(os.getenv("GRAMMAR_CACHE_MAX_ENTRIES", "256"))
+
+    @staticmethod
+    def schema_key(response_format: type[BaseModel]) -> str:
+        schema = json.dumps(response_format.model_json_schema(), sort_keys=True)
+        return "schema:" + hashlib.sha256(schema.encode()).hexdigest()
+
+    def get(self, key: str, build) -> LlamaGrammar:
+        with self.lock:
+            if key in self.grammars:
+                self.grammars.move_to_end(key)
+                return self.grammars[key]
+            grammar = self.grammars[key] = LlamaGrammar.from_string(build(), verbose=False)
+            while len(self.grammars) > max(self.max_entries(), 1):
+                self.grammars.popitem(last=False)
+            return grammar
+
+    def for_response_format(self, response_format: Optional[type[BaseModel]]) -> Optional[LlamaGrammar]:
+        """
+        Returns the grammar constraining generation to the given Pydantic model.
+        """
+        if response_format is None:
+            return None
+        return self.get(
+            self.schema_key(response_format),
+            lambda: generate_gbnf_grammar_and_documentation([response_format])[0]
+        )
+
+    def for_schema(self, db_id: str, tables: Optional[list[str]] = None) -> Optional[LlamaGrammar]:
+        """
+        Returns the grammar of a `{"final_query": ...}` response whose SQL only names the
+        tables and columns of the database (or the given tables), None if it is unknown.
+        """
+        grammar = schema_grammar.for_database(db_id, tables)
+        if grammar is None:
+            return None
+        return self.get("sql:" + hashlib.sha256(grammar.encode()).hexdigest(), lambda: grammar)
+
+    def for_file(self, name: str) -> LlamaGrammar:
+        """
+        Returns the grammar of a static `.gbnf` file in the `grammars/` directory.
+        """
+        path = self.grammar_dir / name
+        return self.get(f"file:{name}:{path.stat().st_mtime}", path.read_text)
+
+    @staticmethod
+    def local_models_installed() -> bool:
+        return any(
+            entry.name.startswith("local") and entry.name.endswith(".gguf")
+            for entry in pkg_resources.files("app.models").iterdir()
+        )
+
+    def warm(self, response_formats: list[type[BaseModel]]):
+        """
+        Compiles the grammars of the response formats and of the `grammars/` directory when a
+        local GGUF model is installed. Grammars that fail to compile are logged and skipped.
+        """
+        if not self.local_models_installed():
+            return
+        for response_format in response_formats:
+            try:
+                self.for_response_format(response_format)
+            except Exception as e:
+                print(f"Skipping the grammar of {response_format.__name__}: {e}")
+        if self.grammar_dir.is_dir():
+            for path in sorted(self.grammar_dir.glob("*.gbnf")):
+                try:
+                    self.for_file(path.name)
+                except Exception as e:
+                    print(f"Skipping grammar {path.name}: {e}")
+
+
+grammar_cache = GrammarCache()
+
+
+class IncrementalJSONParser:
+    """
+    Follows a JSON object of a response format as it is generated, token by token,
+    recording where each top-level field value starts and ends.
+    `complete` turns true as soon as every required field is closed, so generation
+    can be cancelled before the optional fields that follow them.
+    """
+    def __init__(self, response_format: type[BaseModel]):
+        self.response_format = response_format
+        self.required = {
+            name for name, field in response_format.model_fields.items() if field.is_required()
+        }
+        self.text = []
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.key_start = None
+        self.key = None
+        self.value_start = None
+        self.fields: dict[str, tuple[int, int]] = {}
+        self.closed = False
+        self.tokens = 0
+
+    def close_value(self, end: int):
+        self.fields[self.key] = (self.value_start, end)
+        self.key = None
+        self.value_start = None
+
+    def feed(self, text: str):
+        self.text.append(text)
+        self.tokens += 1
+        for offset, char in enumerate(text):
+            position = self.length + offset
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.key_start is not None:
+                        self.key = json.loads("".join(self.text)[self.key_start:position + 1])
+                        self.key_start = None
+                    elif self.depth == 1 and self.value_start is not None:
+                        self.close_value(position + 1)
+                continue
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.key is None:
+                    self.key_start = position
+                elif self.depth == 1 and self.value_start is None:
+                    self.value_start = position
+            elif char in "{[":
+                if self.depth == 1 and self.value_start is None:
+                    self.value_start = position
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.value_start is not None:
+                    self.close_value(position + 1)
+                elif self.depth == 0:
+                    if self.value_start is not None:
+                        self.close_value(position)
+                    self.closed = True
+            elif char == "," and self.depth == 1 and self.value_start is not None:
+                self.close_value(position)
+            elif self.depth == 1 and self.key is not None and self.value_start is None and not char.isspace() and char != ":":
+                # Start of a number, boolean or null
+                self.value_start = position
+        self.length += len(text)
+
+    def complete(self) -> bool:
+        return self.closed or self.required <= self.fields.keys()
+
+    def result(self) -> BaseModel | str:
+        """
+        Materializes the response format from the fields closed so far,
+        or returns the raw text when it does not validate.
+        """
+        text = "".join(self.text)
+        try:
+            values = {
+                key: json.loads(text[start:end]) for key, (start, end) in self.fields.items()
+            }
+            return self.response_format.model_validate(values)
+        except ValueError as e:
+            print(f"Could not parse the response as {self.response_format.__name__}: {e}")
+            return text
+
+
+class ResponseCache:
+    """
+    On-disk cache of model responses keyed by the hash of the built prompt (model, temperature,
+    messages) plus the response schema, so identical calls skip the backend.
+    Entries live in a SQLite file at LLM_CACHE_PATH (default ~/.cache/nlidb/llm_responses.sqlite),
+    expire after LLM_CACHE_TTL seconds (0 keeps them forever) and the least recently used ones
+    are evicted beyond LLM_CACHE_MAX_BYTES. LLM_CACHE_ENABLED=false turns the cache off.
+    """
+    def __init__(self):
+        self.initialized_path = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.getenv("LLM_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+
+    @staticmethod
+    def path() -> str:
+        return os.getenv("LLM_CACHE_PATH") or os.path.expanduser("~/.cache/nlidb/llm_responses.sqlite")
+
+    @staticmethod
+    def key(prompt: Prompt, response_format: Optional[type[BaseModel]]) -> str:
+        schema = response_format.model_json_schema() if response_format else None
+        payload = json.dumps({"prompt": prompt, "schema": schema}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def connect(self) -> sqlite3.Connection:
+        path = self.path()
+        if self.initialized_path != path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        if self.initialized_path != path:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, parsed INTEGER, "
+                "size INTEGER, created_at REAL, accessed_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self.initialized_path = path
+        return conn
+
+    def get(self, key: str, response_format: Optional[type[BaseModel]]) -> Optional[tuple]:
+        """
+        Returns the cached response and its creation time, or None on a miss.
+        """
+        ttl = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            try:
+                with conn:
+                    row = conn.execute(
+                        "SELECT response, parsed, created_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is None:
+                        return None
+                    if ttl > 0 and now - row[2] > ttl:
+                        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        return None
+                    conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            finally:
+                conn.close()
+        response, parsed, created_at = row
+        if parsed:
+            if response_format is None:
+                return None
+            response = response_format.model_validate_json(response)
+        return response, created_at
+
+    def put(self, key: str, model: str, response):
+        parsed = isinstance(response, BaseModel)
+        text = response.model_dump_json() if parsed else response
+        if not isinstance(text, str):
+            return
+        max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, model, text, int(parsed), len(text.encode()), now, now),
+                    )
+                    self.evict(conn, max_bytes)
+            finally:
+                conn.close()
+
+    @staticmethod
+    def evict(conn: sqlite3.Connection, max_bytes: int):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= max_bytes:
+            return
+        removed = 0
+        expired = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if total - removed <= max_bytes:
+                break
+            expired.append((key,))
+            removed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", expired)
+
+    def clear(self):
+        with self.lock:
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM responses")
+            finally:
+                conn.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            conn = self.connect()
+            try:
+                entries, size = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+            finally:
+                conn.close()
+        return {"path": self.path(), "enabled": self.enabled(), "entries": entries, "bytes": size}
+
+
+response_cache = ResponseCache()
 
 
 class InferenceEngine:
     def __init__(self,
         model:str = "gpt-4o-mini", # or hf
-        response_format : Optional[BaseModel] = None
+        response_format : Optional[BaseModel] = None,
+        db_id: Optional[str] = None, # restricts the SQL of local models to this database
+        tables: Optional[list[str]] = None # and these of its tables
     ):
         self.model = model
         self.prompt_type = None
         self.grammar = None
         self.response_format = response_format
+        self.async_client = None
 
         # client probing
         if "gpt" in model:
-            self.client = OpenAI()
+            self.client = model_registry.openai_client()
+            self.async_client = model_registry.openai_client(asynchronous=True)
             self.extra_headers = None
             self.prompt_type = "openai"
         elif "local" in model:
-            self.client = Llama(
-                model_path=pkg_resources.files("app.models").joinpath(model).as_posix(),
-                n_gpu_layers=-1,
-                n_ctx=1024
-                )
+            self.client = model_registry.local_model(model)
             self.extra_headers = None
             self.prompt_type = "llama"
-            grammar_string, documentation = generate_gbnf_grammar_and_documentation([self.response_format])
-            self.grammar = LlamaGrammar.from_string(grammar_string)
+            if db_id and schema_grammar.enabled() and schema_grammar.accepts(self.response_format):
+                self.grammar = grammar_cache.for_schema(db_id, tables)
+            if self.grammar is None:
+                self.grammar = grammar_cache.for_response_format(self.response_format)
         # fallback to huggingface
         else:
-            self.client = OpenAI(
-                base_url="https://api-inference.huggingface.co/v1/",
+            self.client = model_registry.openai_client(
+                base_url=HF_BASE_URL,
                 api_key=os.getenv("HF_TOKEN")
             )
+            self.async_client = model_registry.openai_client(
+                base_url=HF_BASE_URL,
+                api_key=os.getenv("HF_TOKEN"),
+                asynchronous=True
+            )
             self.prompt_type = "hf"
             self.extra_headers = {"X-Wait-For-Model": "true"}
 
-    def generate(self, system_prompt = SystemPrompts.SQL_QUERY_GENERATION, **kwargs):
-        prompt : Prompt = PromptBuilder(). \
+    @classmethod
+    async def acreate(cls, **kwargs) -> "InferenceEngine":
+        """
+        Builds the engine on a worker thread, so async routes never load a local model
+        or compile its grammar on the event loop.
+        """
+        return await asyncio.to_thread(cls, **kwargs)
+
+    def build_prompt(self, system_prompt = SystemPrompts.SQL_QUERY_GENERATION, **kwargs) -> Prompt:
+        return PromptBuilder(). \
             set_prompt(system_prompt.value). \
             set_model_temp(0.3). \
             set_messages([]). \
             set_prompt_type(self.prompt_type). \
             set_model_type(self.model). \
             build(**kwargs)
-        if self.prompt_type == "llama":
-            # Process prompt locally with Llama.cpp
-            if self.response_format and self.grammar:
-                response = self.client(
-                    prompt = prompt["messages"][0]["content"],
-                    grammar=self.grammar,
-                    max_tokens=1024
-                )
-            else:
-                response = self.client(prompt["messages"][0]["content"], max_tokens=1024)
+
+    def generate_llama(self, prompt : Prompt):
+        # Process prompt locally with Llama.cpp, stopping once the response format is complete
+        arguments = self.llama_arguments(prompt)
+        prompt_tokens = arguments.pop("prompt_tokens")
+        if not self.response_format:
+            response = self.client(**arguments)
             return {
                 "prompt": prompt,
                 "response": response['choices'][0]['text'],
-                "grammar": self.grammar
+                "grammar": self.grammar,
+                "prompt_tokens": prompt_tokens,
             }
+        parser = IncrementalJSONParser(self.response_format)
+        for chunk in self.client(**arguments, stream=True):
+            parser.feed(chunk["choices"][0]["text"])
+            if parser.complete():
+                break
+        return {
+            "prompt": prompt,
+            "response": parser.result(),
+            "grammar": self.grammar,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": parser.tokens,
+        }
+
+    def cached(self, prompt: Prompt, use_cache: bool) -> tuple[Optional[str], Optional[dict]]:
+        """
+        Looks the prompt up in `response_cache`.
+
+        Returns:
+            tuple: The cache key (None when caching is off) and the cached result, if any.
+        """
+        if not use_cache or not response_cache.enabled():
+            return None, None
+        key = response_cache.key(prompt, self.response_format)
+        entry = response_cache.get(key, self.response_format)
+        if entry is None:
+            return key, None
+        response, created_at = entry
+        result = {
+            "prompt": prompt,
+            "response": response,
+            "cache": {"hit": True, "key": key, "age": time.time() - created_at},
+        }
+        if self.prompt_type == "llama":
+            result["grammar"] = self.grammar
+        return key, result
+
+    def store(self, key: Optional[str], result: dict) -> dict:
+        if key is None:
+            return {**result, "cache": {"hit": False}}
+        if self.response_format is not None and not isinstance(result["response"], BaseModel):
+            # Unparsed structured output is not cached so that the next identical call regenerates
+            return {**result, "cache": {"hit": False}}
+        response_cache.put(key, self.model, result["response"])
+        return {**result, "cache": {"hit": False, "key": key}}
+
+    def generate(self, system_prompt = SystemPrompts.SQL_QUERY_GENERATION, use_cache: bool = True, **kwargs):
+        prompt = self.build_prompt(system_prompt, **kwargs)
+        key, result = self.cached(prompt, use_cache)
+        if result is not None:
+            return result
+        if self.prompt_type == "llama":
+            return self.store(key, self.generate_llama(prompt))
         else:
             # OpenAI or Hugging Face processing
             if self.response_format and self.prompt_type == "openai": # @TODO backup HF grammar or response_format
                 response = self.client.beta.chat.completions.parse(
-                    **prompt, 
+                    **prompt,
                     response_format=self.response_format,
                     extra_headers=self.extra_headers
                     ).choices[0].message.parsed
             else:
                 response = self.client.chat.completions.create(
-                    **prompt, 
+                    **prompt,
                     extra_headers=self.extra_headers
                     ).choices[0].message.content
-            return {
+            return self.store(key, {
                 "prompt": prompt,
                 "response": response
-            }
\ No newline at end of file
+            })
+
+    async def agenerate(self, system_prompt = SystemPrompts.SQL_QUERY_GENERATION, use_cache: bool = True, **kwargs):
+        """
+        Non-blocking counterpart of `generate` for use inside async routes.
+        """
+        prompt = self.build_prompt(system_prompt, **kwargs)
+        key, result = await asyncio.to_thread(self.cached, prompt, use_cache)
+        if result is not None:
+            return result
+        if self.prompt_type == "llama":
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(llama_executor, self.generate_llama, prompt)
+        else:
+            # OpenAI or Hugging Face processing
+            if self.response_format and self.prompt_type == "openai":
+                response = (await self.async_client.beta.chat.completions.parse(
+                    **prompt,
+                    response_format=self.response_format,
+                    extra_headers=self.extra_headers
+                    )).choices[0].message.parsed
+            else:
+                response = (await self.async_client.chat.completions.create(
+                    **prompt,
+                    extra_headers=self.extra_headers
+                    )).choices[0].message.content
+            result = {
+                "prompt": prompt,
+                "response": response
+            }
+        return await asyncio.to_thread(self.store, key, result)
+
+    def llama_arguments(self, prompt: Prompt) -> dict:
+        """
+        Completion arguments of the llama.cpp path, generating at most what is left of the context.
+        """
+        prompt_tokens = len(self.client.tokenize(prompt["messages"][0]["content"].encode()))
+        max_tokens = min(1024, self.client.n_ctx() - prompt_tokens)
+        if max_tokens <= 0:
+            raise ValueError(
+                f"The prompt has {prompt_tokens} tokens, the context window of {self.model} is {self.client.n_ctx()}"
+            )
+        arguments = {"prompt": prompt["messages"][0]["content"], "max_tokens": max_tokens}
+        if self.response_format and self.grammar:
+            arguments["grammar"] = self.grammar
+        return {**arguments, "prompt_tokens": prompt_tokens}
+
+    async def stream_llama(self, prompt: Prompt, parser: Optional[IncrementalJSONParser] = None) -> AsyncIterator[str]:
+        """
+        Streams the completion text of the local model from its worker thread.
+        Generation stops once the consumer stops iterating or `parser` is complete.
+        """
+        arguments = self.llama_arguments(prompt)
+        arguments.pop("prompt_tokens")
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for chunk in self.client(**arguments, stream=True):
+                    if stopped.is_set():
+                        break
+                    text = chunk["choices"][0]["text"]
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+                    if parser:
+                        parser.feed(text)
+                        if parser.complete():
+                            break
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        loop.run_in_executor(llama_executor, produce)
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+
+    async def astream(self, system_prompt = SystemPrompts.SQL_QUERY_GENERATION, use_cache: bool = True, **kwargs) -> AsyncIterator[dict]:
+        """
+        Streaming counterpart of `agenerate`: yields {"token": text} for every generated chunk,
+        then {"result": ...} with the same result `agenerate` returns. A cached response is
+        returned as the result without tokens. Structured responses of the local and OpenAI
+        models are parsed as they stream and generation is cancelled once every required
+        field is complete.
+        """
+        prompt = self.build_prompt(system_prompt, **kwargs)
+        key, result = await asyncio.to_thread(self.cached, prompt, use_cache)
+        if result is not None:
+            yield {"result": result}
+            return
+
+        chunks = []
+        parser = None
+        if self.prompt_type == "llama":
+            parser = IncrementalJSONParser(self.response_format) if self.response_format else None
+            async for text in self.stream_llama(prompt, parser):
+                chunks.append(text)
+                yield {"token": text}
+        elif self.response_format and self.prompt_type == "openai":
+            parser = IncrementalJSONParser(self.response_format)
+            # Leaving the stream early closes the connection, which cancels the generation
+            async with self.async_client.beta.chat.completions.stream(
+                **prompt,
+                response_format=self.response_format,
+                extra_headers=self.extra_headers
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content.delta":
+                        parser.feed(event.delta)
+                        yield {"token": event.delta}
+                        if parser.complete():
+                            break
+        else:
+            stream = await self.async_client.chat.completions.create(
+                **prompt,
+                stream=True,
+                extra_headers=self.extra_headers
+            )
+            async for chunk in stream:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    chunks.append(text)
+                    yield {"token": text}
+
+        result = {"prompt": prompt, "response": parser.result() if parser else "".join(chunks)}
+        if parser:
+            result["completion_tokens"] = parser.tokens
+        if self.prompt_type == "llama":
+            result["grammar"] = self.grammar
+        yield {"result": await asyncio.to_thread(self.store, key, result)}
+
+
+class Pipeline:
+    """
+    In-process text-to-SQL pipeline:
+    classify database -> extract tables -> extract columns -> generate SQL -> execute.
+    The HTTP routes are thin wrappers around these steps.
+    """
+    def __init__(self, linking_model: str = ModelChoices.GPT4o):
+        self.linking_model = linking_model
+        self.classification_engine = ClassificationEngine()
+        self.db_batcher = ClassificationBatcher(self.classification_engine.classify_top_k)
+        self.table_batcher = ClassificationBatcher(self.classification_engine.classify_tables_batch)
+        self.db_engine = DBEngine()
+
+    async def aclassify_db(self, nlq: str, top_k: int = 1) -> list[tuple[str, float]]:
+        """
+        Top-k databases for the NLQ, micro-batched with concurrent requests.
+        """
+        return await self.db_batcher.classify((nlq, top_k))
+
+    async def rank_databases(self, nlqs: list[str], top_k: int = 1) -> list[list[tuple[str, float]]]:
+        """
+        Top-k databases for every NLQ in one vectorized pass.
+        """
+        return await asyncio.to_thread(self.classification_engine.classify_batch, nlqs, "db", top_k)
+
+    async def classify_tables(self, nlq: str, db: str) -> tuple[Optional[ExtractTables], float]:
+        """
+        Tables predicted by the local classifier, with catalog table names, and its confidence.
+        Returns no tables when a predicted table is not in the schema catalog.
+        """
+        tables, confidence = await self.table_batcher.classify((nlq, db))
+        catalog_names = {name.lower(): name for name in schema_catalog.get_tables(db)}
+        if not all(table in catalog_names for table in tables):
+            return None, confidence
+        return ExtractTables(table_names=[catalog_names[table] for table in tables]), confidence
+
+    async def extract_tables(
+        self, nlq: str, db: str, use_cache: bool = True, token_usage: Optional[dict] = None
+    ) -> ExtractTables:
+        """
+        Picks the relevant tables of the database. TABLE_EXTRACTION_MODE selects how:
+        "llm" always asks the linking model, "local" always uses the table classifier, and
+        "gated" (default) trusts the classifier when its confidence reaches
+        TABLE_CLASSIFIER_MIN_CONFIDENCE (default 0.9) and asks the linking model otherwise.
+        The schema token counts of the prompt are added to `token_usage`, see `schema_prompt`.
+        """
+        mode = os.getenv("TABLE_EXTRACTION_MODE", "gated")
+        if mode != "llm":
+            try:
+                tables, confidence = await self.classify_tables(nlq, db)
+            except ValueError:
+                if mode == "local":
+                    raise
+                tables, confidence = None, 0.0
+            min_confidence = float(os.getenv("TABLE_CLASSIFIER_MIN_CONFIDENCE", "0.9"))
+            if tables is not None and (mode == "local" or confidence >= min_confidence):
+                return tables
+            if mode == "local":
+                raise ValueError(f"The table classifier predicted tables missing from database: {db}")
+
+        inference_engine = await InferenceEngine.acreate(
+            model=self.linking_model,
+            response_format=ExtractTables
+        )
+        db_schema, tokens = await asyncio.to_thread(
+            self.schema_prompt, inference_engine, SystemPrompts.EXTRACT_TABLES, nlq, db
+        )
+        if token_usage is not None:
+            token_usage["extract_tables"] = tokens
+        return (await inference_engine.agenerate(
+            system_prompt=SystemPrompts.EXTRACT_TABLES,
+            use_cache=use_cache,
+            nlq=nlq,
+            db_schema=db_schema
+        ))["response"]
+
+    @staticmethod
+    def schema_budget(engine: InferenceEngine, system_prompt: SystemPrompts, count_tokens: Callable[[str], int], **kwargs) -> Optional[int]:
+        """
+        Tokens the schema may take in a prompt: SCHEMA_TOKEN_BUDGET, and for local models what the
+        context window leaves after the rest of the prompt and LOCAL_OUTPUT_TOKENS (default 256)
+        for the response. None when neither applies.
+        """
+        budgets = []
+        if os.getenv("SCHEMA_TOKEN_BUDGET"):
+            budgets.append(int(os.getenv("SCHEMA_TOKEN_BUDGET")))
+        context_window = token_counter.context_window(engine.model)
+        if context_window:
+            prompt = engine.build_prompt(system_prompt, db_schema=" ", **kwargs)["messages"][0]["content"]
+            reserved = int(os.getenv("LOCAL_OUTPUT_TOKENS", "256"))
+            budgets.append(context_window - reserved - count_tokens(prompt))
+        return max(min(budgets), 0) if budgets else None
+
+    def schema_prompt(
+        self, engine: InferenceEngine, system_prompt: SystemPrompts, nlq: str, db: str, table_name: Optional[str] = None
+    ) -> tuple[str, dict]:
+        """
+        Schema text for a linking prompt and its token counts for the engine's model.
+        The tables and columns are the `schema_index` shortlist for the NLQ, or the whole database /
+        table when SCHEMA_INDEX_ENABLED is false, compacted by `compact_schema` to `schema_budget`.
+        """
+        tables = [table_name] if table_name else None
+        if os.getenv("SCHEMA_INDEX_ENABLED", "true").lower() in ("0", "false", "no"):
+            shortlist = schema_index.shortlist(db, nlq, top_tables=sys.maxsize, top_columns=sys.maxsize, tables=tables)
+        else:
+            shortlist = schema_index.shortlist(db, nlq, tables=tables)
+        count_tokens = token_counter.counter(engine.model)
+        budget = self.schema_budget(engine, system_prompt, count_tokens, nlq=nlq)
+        return compact_schema(shortlist, count_tokens, budget, schema_index.key_columns(db))
+
+    async def extract_columns(
+        self, nlq: str, db: str, table_name: str, use_cache: bool = True, token_usage: Optional[dict] = None
+    ) -> ExtractColumns:
+        inference_engine = await InferenceEngine.acreate(
+            model=self.linking_model,
+            response_format=ExtractColumns
+        )
+        db_schema, tokens = await asyncio.to_thread(
+            self.schema_prompt, inference_engine, SystemPrompts.EXTRACT_COLUMNS, nlq, db, table_name
+        )
+        if token_usage is not None:
+            token_usage.setdefault("extract_columns", {})[table_name] = tokens
+        return (await inference_engine.agenerate(
+            system_prompt=SystemPrompts.EXTRACT_COLUMNS,
+            use_cache=use_cache,
+            nlq=nlq,
+            db_schema=db_schema
+        ))["response"]
+
+    async def extract_all_columns(
+        self, nlq: str, db: str, tables: list[str], use_cache: bool = True, token_usage: Optional[dict] = None
+    ) -> tuple[dict, dict]:
+        """
+        Extracts the relevant columns of every table concurrently.
+
+        Returns:
+            tuple[dict, dict]: Column names of the tables that succeeded, and the
+            error message of the tables that failed or timed out.
+        """
+        concurrency = int(os.getenv("COLUMN_EXTRACTION_CONCURRENCY", "4"))
+        timeout = float(os.getenv("COLUMN_EXTRACTION_TIMEOUT", "60"))
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def extract(table_name: str) -> list[str]:
+            async with semaphore:
+                columns_response = await asyncio.wait_for(
+                    self.extract_columns(nlq, db, table_name, use_cache, token_usage),
+                    timeout=timeout
+                )
+                return columns_response.model_dump(mode="json").get("column_names", [])
+
+        results = await asyncio.gather(
+            *(extract(table_name) for table_name in tables),
+            return_exceptions=True
+        )
+
+        relevant_columns = {}
+        failed_tables = {}
+        for table_name, result in zip(tables, results):
+            if isinstance(result, BaseException):
+                failed_tables[table_name] = str(result) or type(result).__name__
+            else:
+                relevant_columns[table_name] = result
+        return relevant_columns, failed_tables
+
+    async def link_schema_stages(
+        self, nlq: str, use_cache: bool = True, token_usage: Optional[dict] = None
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Classifies the NLQ into a database, its relevant tables and their relevant columns,
+        yielding ("db" | "tables" | "columns", data) as soon as each stage finishes.
+        The schema token counts of the linking prompts are added to `token_usage`.
+        """
+        # Step 1: Classify Database
+        predicted_db, score = (await self.aclassify_db(nlq))[0]
+        if not predicted_db:
+            raise ValueError("Database classification failed. Please provide a valid query.")
+        yield "db", {"db": predicted_db, "score": score}
+
+        # Step 2: Extract Relevant Tables
+        tables_response = await self.extract_tables(nlq, predicted_db, use_cache, token_usage)
+        if not tables_response or not tables_response.table_names:
+            raise ValueError(f"No relevant tables found for the database: {predicted_db}")
+        yield "tables", {"tables": tables_response.table_names}
+
+        # Step 3: Extract Relevant Columns, one concurrent call per table
+        relevant_columns, failed_tables = await self.extract_all_columns(
+            nlq, predicted_db, tables_response.table_names, use_cache, token_usage
+        )
+        if not relevant_columns:
+            raise ValueError(f"Column extraction failed for every table: {failed_tables}")
+        yield "columns", {"columns": relevant_columns, "failed_tables": failed_tables}
+
+    async def link_schema(self, nlq: str, use_cache: bool = True, token_usage: Optional[dict] = None) -> dict:
+        """
+        Classifies the NLQ into a database, its relevant tables and their relevant columns.
+        The schema token counts of the linking prompts are added to `token_usage`.
+        """
+        stages = {}
+        async for stage, data in self.link_schema_stages(nlq, use_cache, token_usage):
+            stages[stage] = data
+        return {
+            "db": stages["db"]["db"],
+            "tables": list(stages["columns"]["columns"]),
+            "columns": stages["columns"]["columns"],
+            "failed_tables": stages["columns"]["failed_tables"],
+        }
+
+    @staticmethod
+    def sql_response_format() -> type[BaseModel]:
+        """
+        Response format of the SQL generation step. SQL_RESPONSE_LAYOUT "final_first" generates
+        `final_query` before the optional reasoning fields and "final_only" drops them, so
+        structured decoding stops after far fewer tokens than the default "full" layout.
+        """
+        layout = os.getenv("SQL_RESPONSE_LAYOUT", "full")
+        if layout not in SQL_RESPONSE_LAYOUTS:
+            raise ValueError(f"Unknown SQL_RESPONSE_LAYOUT {layout!r}, expected one of {list(SQL_RESPONSE_LAYOUTS)}")
+        return SQL_RESPONSE_LAYOUTS[layout]
+
+    @staticmethod
+    def sql_prompt_arguments(schema_links: dict) -> dict:
+        """
+        Template arguments of the SQL generation prompt for the linked schema.
+        """
+        db = schema_links.get("db")
+        tables = schema_links.get("tables", [])
+        columns = [
+            table + "." + column
+            for table, column_list in schema_links.get("columns", {}).items()
+            for column in column_list
+        ]
+        if not db or not tables or not columns:
+            raise ValueError("Incomplete classification results received.")
+        return {"tables": tables, "columns": columns}
+
+    @staticmethod
+    def schema_tokens(token_usage: dict) -> dict:
+        """
+        Schema tokens of the linking prompts before and after compaction, in total and per prompt.
+        """
+        prompts = [token_usage["extract_tables"]] if "extract_tables" in token_usage else []
+        prompts += list(token_usage.get("extract_columns", {}).values())
+        return {
+            "before": sum(tokens["before"] for tokens in prompts),
+            "after": sum(tokens["after"] for tokens in prompts),
+            **token_usage,
+        }
+
+    async def generate_sql(self, nlq: str, clarifications: list[str], model: str, use_cache: bool = True) -> dict:
+        """
+        Links the schema for the NLQ and generates the SQL query with the given model.
+        Unset `use_cache` to bypass `response_cache` for every model call.
+        The result reports the schema tokens of the linking prompts before and after compaction.
+        """
+        token_usage = {}
+        schema_links = await self.link_schema(nlq, use_cache, token_usage)
+        engine = await InferenceEngine.acreate(
+            model=model,
+            response_format=self.sql_response_format(),
+            db_id=schema_links["db"],
+            tables=schema_links["tables"],
+        )
+        result = await engine.agenerate(
+            use_cache=use_cache,
+            nlq=nlq,
+            clarifications=clarifications,
+            **self.sql_prompt_arguments(schema_links),
+        )
+        return {**result, "schema_tokens": self.schema_tokens(token_usage)}
+
+    async def stream_sql(
+        self, nlq: str, clarifications: list[str], model: str, use_cache: bool = True
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Streaming counterpart of `generate_sql`. Yields the schema linking stages ("db", "tables",
+        "columns") as they finish, then ("token", {"text": ...}) for every generated chunk of the
+        SQL response and finally ("result", ...) with what `generate_sql` returns.
+        Errors are yielded as a final ("error", {"detail": ...}).
+        """
+        try:
+            token_usage = {}
+            schema_links = {}
+            async for stage, data in self.link_schema_stages(nlq, use_cache, token_usage):
+                schema_links.update(data)
+                yield stage, data
+            schema_links["tables"] = list(schema_links["columns"])
+            engine = await InferenceEngine.acreate(
+                model=model,
+                response_format=self.sql_response_format(),
+                db_id=schema_links["db"],
+                tables=schema_links["tables"],
+            )
+
+            async for event in engine.astream(
+                use_cache=use_cache,
+                nlq=nlq,
+                clarifications=clarifications,
+                **self.sql_prompt_arguments(schema_links),
+            ):
+                if "token" in event:
+                    yield "token", {"text": event["token"]}
+                else:
+                    yield "result", {**event["result"], "schema_tokens": self.schema_tokens(token_usage)}
+        except Exception as e:
+            yield "error", {"detail": str(e)}
+
+    async def execute(
+        self,
+        sql: str,
+        db_id: Optional[str] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        use_cache: bool = True,
+    ) -> dict:
+        """
+        Executes the SQL query on the database's connection pool without blocking the event loop.
+        The result holds at most `max_rows` rows / `max_bytes` bytes, see `DBEngine.fetch_postgresql_query`.
+        Results of SELECT-like queries are served from `query_cache` unless `use_cache` is unset.
+        """
+        db_id = db_id or connection_pools.default_db()
+        max_rows, max_bytes = self.db_engine.fetch_limits(max_rows, max_bytes)
+        if use_cache:
+            cached = await asyncio.to_thread(query_cache.get, db_id, sql, max_rows, max_bytes)
+            if cached is not None:
+                return cached
+        result = await asyncio.to_thread(
+            self.db_engine.fetch_postgresql_query, sql, db_id, max_rows, max_bytes
+        )
+        if use_cache:
+            await asyncio.to_thread(query_cache.put, db_id, sql, result)
+        return result
+
+    async def stream(self, sql: str, db_id: Optional[str] = None, max_rows: Optional[int] = None) -> Iterator[str]:
+        """
+        Starts the SQL query and returns its result as an iterator of NDJSON lines.
+        Errors raised while starting the query are raised here rather than mid-stream.
+        """
+        batches = self.db_engine.stream_postgresql_query(sql, db_id)
+        columns = await asyncio.to_thread(next, batches)
+        return ndjson_lines(columns, batches, max_rows)
+
+
+pipeline = Pipeline()
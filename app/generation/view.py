@@ -1,64 +1,56 @@
 from app.generation import router
-from app.generation.service import InferenceEngine
-from app.generation.model import (
-    NLQRequest, 
-    InferenceResponseFormat,
-    SQLGenerationResult
-)
+from app.generation.service import pipeline, response_cache
+from app.generation.model import NLQRequest
+from app.db.service import encode_event
 from fastapi import HTTPException
-import httpx  # For making HTTP requests to localhost endpoints.
+from fastapi.responses import StreamingResponse
 
 @router.post("/infer")
 async def infer(request : NLQRequest):
     """
     A simple endpoint to infer a query.
 
-    Returns: the generated query
+    Returns: the generated query, or with `format` "ndjson" or "sse" a stream of
+    the db, tables and columns stages, the SQL tokens and the final result.
 
     """
-    engine = InferenceEngine(
-        model=request.model,
-        response_format=SQLGenerationResult
-    )
-    try:
-        # Step 1: Send the NLQ to the /all_incremental endpoint.
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://127.0.0.1:8000/classification/all_incremental",
-                json={"nlq": request.natural_language_query},
-            )
-
-        # Ensure the response is successful.
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Failed to classify NLQ: {response.text}"
-            )
+    if request.format != "json":
+        async def stream():
+            async for event, data in pipeline.stream_sql(
+                nlq=request.natural_language_query,
+                clarifications=request.clarifications,
+                model=request.model,
+                use_cache=request.cache,
+            ):
+                yield encode_event(event, data, request.format)
+
+        media_type = "text/event-stream" if request.format == "sse" else "application/x-ndjson"
+        return StreamingResponse(stream(), media_type=media_type)
 
-        # Parse the response from /all_incremental.
-        classification_results = response.json()
-        db = classification_results.get("db")
-        tables = classification_results.get("tables", [])
-        columns_dict = classification_results.get("columns", {})
-        columns = []
-        for table, column_list in columns_dict.items():
-            for column in column_list:
-                columns.append(table + "." + column)
+    try:
+        return await pipeline.generate_sql(
+            nlq=request.natural_language_query,
+            clarifications=request.clarifications,
+            model=request.model,
+            use_cache=request.cache,
+        )
 
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        if not db or not tables or not columns:
-            raise ValueError("Incomplete classification results received.")
 
-        # Step 2: Pass classification results to the inference engine.
-        kwargs = {
-            "nlq": request.natural_language_query,
-            "tables": tables,
-            "columns": columns,
-            "clarifications": request.clarifications,
-        }
+@router.get("/cache")
+def get_response_cache():
+    """
+    Entries and size of the on-disk model response cache.
+    """
+    return response_cache.stats()
 
-        # Generate the SQL query.
-        return engine.generate(**kwargs)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+@router.delete("/cache")
+def clear_response_cache():
+    """
+    Drops every cached model response.
+    """
+    response_cache.clear()
+    return response_cache.stats()
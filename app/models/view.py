@@ -1,5 +1,6 @@
 from app.models import router
 from app.prompts.model import ModelChoices
+from app.generation.service import model_registry
 import importlib.resources as pkg_resources
 import os
 
@@ -7,6 +8,13 @@ import os
 def get_model_list():
     return list(filter(lambda x: x.endswith(".pkl") or x.endswith(".gguf"), os.listdir(pkg_resources.files("app.models"))))
 
+@router.get("/registry")
+def get_model_registry():
+    """
+    Resident local models, load/evict events and process memory of the model registry.
+    """
+    return model_registry.stats()
+
 @router.get("/all_models")
 def get_model_list_all():
     return [m.value for m in ModelChoices]
@@ -1,5 +1,42 @@
-from jinja2 import Environment, FileSystemLoader
+from functools import cache
+from pathlib import Path
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from app.prompts.model import Prompt, ModelChoices
+from app.constants import SystemPrompts
+import os
+
+TEMPLATE_DIR = Path(__file__).resolve().parent
+
+
+@cache
+def get_environment() -> Environment:
+    """
+    Returns the shared Jinja environment.
+    Compiled templates stay in memory and are not re-checked on disk unless
+    PROMPT_TEMPLATE_AUTO_RELOAD is set; PROMPT_BYTECODE_CACHE_DIR enables an
+    on-disk bytecode cache shared between processes.
+    """
+    bytecode_cache_dir = os.getenv("PROMPT_BYTECODE_CACHE_DIR")
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=bytecode_cache,
+        auto_reload=os.getenv("PROMPT_TEMPLATE_AUTO_RELOAD", "").lower() in ("1", "true"),
+        cache_size=-1,
+    )
+
+
+def precompile_templates():
+    """
+    Compiles the system prompt templates ahead of the first request.
+    """
+    env = get_environment()
+    for system_prompt in SystemPrompts:
+        env.get_template(system_prompt.value)
+
 
 class PromptBuilder:
     def __init__(self):
@@ -43,8 +80,7 @@ class PromptBuilder:
         return self
     
     def build(self, **kwargs):
-        env = Environment(loader=FileSystemLoader('app/prompts'))
-        template = env.get_template(self.template_path)
+        template = get_environment().get_template(self.template_path)
 
         # Render system prompt with variables
         self.prompt = template.render(**kwargs)
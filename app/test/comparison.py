@@ -0,0 +1,164 @@
+from typing import Any, Sequence
+from collections import Counter
+import re
+import numpy as np
+import pandas as pd
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`")
+ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+NUMERIC_KINDS = ("integer", "floating", "mixed-integer-float", "decimal", "boolean")
+
+
+def has_top_level_order_by(sql: str) -> bool:
+    """
+    Whether the outermost query of `sql` has an ORDER BY clause.
+    ORDER BY inside subqueries (e.g. `= (SELECT ... ORDER BY ... LIMIT 1)`) does not order the result.
+    """
+    sql = STRING_LITERAL.sub("''", sql or "")
+    depth = 0
+    top_level = []
+    for char in sql:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            top_level.append(char)
+            continue
+        top_level.append(" ")
+    return ORDER_BY.search("".join(top_level)) is not None
+
+
+def freeze(value: Any) -> Any:
+    """
+    Hashable form of a value: arrays (lists) become tuples and JSON objects (dicts) sorted item tuples.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), freeze(item)) for key, item in value.items()))
+    if isinstance(value, set):
+        return frozenset(freeze(item) for item in value)
+    return value
+
+
+def hashes(values: Sequence[Any]) -> np.ndarray:
+    try:
+        return np.fromiter(map(hash, values), dtype=np.int64, count=len(values)).view(np.uint64)
+    except TypeError:
+        # Array and JSON values come back from the driver as lists and dicts
+        return np.fromiter(
+            (hash(freeze(value)) for value in values), dtype=np.int64, count=len(values)
+        ).view(np.uint64)
+
+
+def normalized_column(rows: Sequence[Sequence[Any]], index: int, decimals: int) -> Sequence[Any]:
+    """
+    Normalizes one column so that equal results compare equally regardless of driver types:
+    numeric and boolean columns become the bits of float64 values rounded to `decimals` places
+    (ints compare equal to floats and Decimals), other non-string columns such as dates strings.
+    """
+    column = [row[index] for row in rows]
+    kind = pd.api.types.infer_dtype(column, skipna=True)
+    if kind in NUMERIC_KINDS:
+        values = np.round(np.array(column, dtype=np.float64), decimals) + 0.0  # -0.0 -> 0.0
+        values[np.isnan(values)] = np.nan  # one NaN bit pattern for NULLs
+        return values.view(np.uint64)
+    if kind not in ("string", "empty"):
+        column = [None if value is None else str(value) for value in column]
+    return column
+
+
+def column_hashes(column: Sequence[Any]) -> np.ndarray:
+    """
+    Hashes a normalized column; the bits of numeric columns are their own hashes.
+    """
+    if isinstance(column, np.ndarray):
+        return column
+    return hashes(column)
+
+
+def same_hashes(groundtruth_hashes: np.ndarray, inferred_hashes: np.ndarray, ordered: bool) -> bool:
+    if not ordered:
+        groundtruth_hashes = np.sort(groundtruth_hashes)
+        inferred_hashes = np.sort(inferred_hashes)
+    return bool(np.array_equal(groundtruth_hashes, inferred_hashes))
+
+
+def same_rows(groundtruth_rows: Sequence[Sequence[Any]], inferred_rows: Sequence[Sequence[Any]], ordered: bool) -> bool:
+    """
+    Exact comparison of two result sets, confirming that matching hashes are not collisions.
+    """
+    groundtruth_rows = [freeze(tuple(row)) for row in groundtruth_rows]
+    inferred_rows = [freeze(tuple(row)) for row in inferred_rows]
+    if ordered:
+        return groundtruth_rows == inferred_rows
+    return Counter(groundtruth_rows) == Counter(inferred_rows)
+
+
+def combined_hashes(column_hashes: list[np.ndarray]) -> np.ndarray:
+    """
+    Combines per-column hashes into one row hash without materializing row tuples.
+    """
+    combined = np.zeros(len(column_hashes[0]), dtype=np.uint64)
+    for column in column_hashes:
+        # uint64 arithmetic wraps around
+        combined = (combined * np.uint64(1000003)) ^ column
+    return combined
+
+
+def results_match(
+    groundtruth_rows: Sequence[Sequence[Any]],
+    inferred_rows: Sequence[Sequence[Any]],
+    ordered: bool = False,
+    decimals: int = 6,
+) -> bool:
+    """
+    Compares two result sets with BIRD execution-accuracy semantics.
+
+    Rows are compared as multisets unless `ordered` is set (the groundtruth SQL has a top-level
+    ORDER BY), and numbers are compared after rounding to `decimals` places. Row and column
+    counts are checked first, then (sorted) arrays of row hashes as returned by the driver.
+    Only if those differ, the normalized columns are compared one by one before their
+    combined row hashes. Hashes only reject results early: matching hashes are confirmed
+    by comparing the rows themselves, so collisions never count as matches.
+
+    Args:
+        groundtruth_rows: Rows of the groundtruth query.
+        inferred_rows: Rows of the inferred query.
+        ordered (bool): Whether row order is significant.
+        decimals (int): Decimal places numbers are rounded to before comparison.
+
+    Returns:
+        bool: Whether the result sets match.
+    """
+    if len(groundtruth_rows) != len(inferred_rows):
+        return False
+    if not groundtruth_rows:
+        return True
+    if len(groundtruth_rows[0]) != len(inferred_rows[0]):
+        return False
+
+    # Identical results need no normalization
+    if same_hashes(hashes(groundtruth_rows), hashes(inferred_rows), ordered) and same_rows(
+        groundtruth_rows, inferred_rows, ordered
+    ):
+        return True
+
+    groundtruth_columns, groundtruth_hashes = [], []
+    inferred_columns, inferred_hashes = [], []
+    for index in range(len(groundtruth_rows[0])):
+        groundtruth_columns.append(normalized_column(groundtruth_rows, index, decimals))
+        inferred_columns.append(normalized_column(inferred_rows, index, decimals))
+        groundtruth_hashes.append(column_hashes(groundtruth_columns[-1]))
+        inferred_hashes.append(column_hashes(inferred_columns[-1]))
+        # Matching rows need matching columns, which are much cheaper to compare
+        if not same_hashes(groundtruth_hashes[-1], inferred_hashes[-1], ordered):
+            return False
+    if not same_hashes(combined_hashes(groundtruth_hashes), combined_hashes(inferred_hashes), ordered):
+        return False
+    return same_rows(
+        list(zip(*(list(column) for column in groundtruth_columns))),
+        list(zip(*(list(column) for column in inferred_columns))),
+        ordered,
+    )
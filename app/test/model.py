@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Literal, Optional
 from app.prompts.model import ModelChoices
 
 class TestRequest(BaseModel):
@@ -8,4 +9,15 @@ class TestRequest(BaseModel):
     evidence: str
     SQL: str
     difficulty: str
-    model: ModelChoices | str = "gpt-4o"
\ No newline at end of file
+    model: ModelChoices | str = "gpt-4o"
+    cache: bool = True
+
+class BulkTestRequest(BaseModel):
+    model: ModelChoices | str = "gpt-4o"
+    db_id: Optional[list[str]] = None          # only evaluate these databases
+    difficulty: Optional[list[str]] = None     # e.g. ["simple", "moderate", "challenging"]
+    limit: Optional[int] = None
+    concurrency: Optional[int] = None          # defaults to EVAL_CONCURRENCY
+    checkpoint: Optional[str] = None           # run name of the JSONL file of finished items under EVAL_CHECKPOINT_DIR, to resume a run
+    format: Literal["json", "ndjson", "sse"] = "json"
+    cache: bool = True                         # serve unchanged model calls from the response cache
@@ -0,0 +1,227 @@
+from typing import AsyncIterator
+from app.test.model import TestRequest, BulkTestRequest
+from app.db.service import json_default
+from app.test.comparison import has_top_level_order_by, results_match
+from app.generation.service import pipeline
+from pydantic import BaseModel
+import asyncio
+import importlib.resources as pkg_resources
+import json
+import os
+import sys
+
+
+def final_query_of(response) -> str | None:
+    """
+    Extracts `final_query` from a parsed response model or its raw JSON text.
+    """
+    if isinstance(response, BaseModel):
+        return getattr(response, "final_query", None)
+    if isinstance(response, str):
+        try:
+            response = json.loads(response)
+        except json.JSONDecodeError:
+            return None
+    if isinstance(response, dict):
+        return response.get("final_query")
+    return None
+
+
+async def execute_query(sql: str, db_id: str | None = None) -> dict:
+    """
+    Executes a query for evaluation, capped at EVAL_MAX_ROWS rows (default 1,000,000).
+    Returns the `DBEngine.fetch_postgresql_query` result, or a dict with the `error`.
+    """
+    try:
+        return await pipeline.execute(
+            sql, db_id, max_rows=int(os.getenv("EVAL_MAX_ROWS", "1000000")), max_bytes=sys.maxsize
+        )
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def first_value(result: dict):
+    rows = result.get("rows")
+    return rows[0][0] if rows and rows[0] else None
+
+
+async def infer_and_compare(request: TestRequest) -> dict:
+    """
+    1. Generate the SQL query for the question.
+    2. Execute both groundtruth and inferred SQL queries on the database.
+    3. Compare the full result sets of the queries.
+    """
+    # Step 1: Generate the SQL query in-process
+    infer_data = await pipeline.generate_sql(
+        nlq=request.question,
+        clarifications=[request.evidence],
+        model=request.model,
+        use_cache=request.cache,
+    )
+    inferred_sql_query = final_query_of(infer_data.get("response"))
+    if not inferred_sql_query:
+        raise ValueError("No SQL query was inferred from the pipeline: " + str(infer_data.get("response")))
+
+    # Step 2: Execute the ground-truth SQL query
+    groundtruth = await execute_query(request.SQL, request.db_id)
+    groundtruth_error = groundtruth.get("error")
+
+    # Step 3: Execute the inferred SQL query
+    inferred = await execute_query(inferred_sql_query, request.db_id)
+    inferred_error = inferred.get("error")
+
+    # Determine if the inferred query is valid
+    valid = inferred_error is None
+
+    # Step 4: Compare the result sets if both queries ran
+    match = False
+    if valid and groundtruth_error is None:
+        match = results_match(
+            groundtruth["rows"],
+            inferred["rows"],
+            ordered=has_top_level_order_by(request.SQL),
+        )
+
+    # Prepare the evaluation result
+    return {
+        "valid": valid,  # Whether the inferred query executed successfully
+        "match": match,  # Whether the result sets match
+        "groundtruth_result": first_value(groundtruth),
+        "groundtruth_row_count": groundtruth.get("row_count"),
+        "groundtruth_error": groundtruth_error,
+        "inferred_result": first_value(inferred) if valid else None,  # Result if valid
+        "inferred_row_count": inferred.get("row_count") if valid else None,
+        "truncated": bool(groundtruth.get("truncated") or inferred.get("truncated")),
+        "inferred_sql_query": inferred_sql_query,
+        "error": inferred_error if not valid else None  # Include error if invalid
+    }
+
+
+class BulkEvaluation:
+    """
+    Evaluates the entries of `mini_dev_postgresql.json` with at most `concurrency` in flight,
+    yielding each result as soon as it finishes. With a checkpoint name, every finished entry
+    is appended to that file under EVAL_CHECKPOINT_DIR (default ~/.cache/nlidb/eval_checkpoints)
+    and entries already evaluated there are skipped on the next run.
+    """
+    def __init__(self, request: BulkTestRequest):
+        self.request = request
+        self.checkpoint = self.checkpoint_path(request.checkpoint) if request.checkpoint else None
+        self.concurrency = max(request.concurrency or int(os.getenv("EVAL_CONCURRENCY", "4")), 1)
+        self.resumed: list[dict] = []
+        self.summary = {
+            "total_requests": 0,
+            "resumed_requests": 0,
+            "valid_requests": 0,
+            "invalid_requests": 0,
+            "failed_requests": 0,
+        }
+
+    def load_requests(self) -> list[dict]:
+        with pkg_resources.files("app.test").joinpath("mini_dev_postgresql.json").open("r") as file:
+            test_requests = json.load(file)
+        if self.request.db_id:
+            test_requests = [entry for entry in test_requests if entry["db_id"] in self.request.db_id]
+        if self.request.difficulty:
+            test_requests = [entry for entry in test_requests if entry["difficulty"] in self.request.difficulty]
+        if self.request.limit is not None:
+            test_requests = test_requests[:self.request.limit]
+        return test_requests
+
+    @staticmethod
+    def checkpoint_path(name: str) -> str:
+        """
+        Resolves a checkpoint name to its file in the checkpoint directory.
+        Directories in the name are dropped; names resolving outside the directory are rejected.
+        """
+        directory = os.path.realpath(
+            os.getenv("EVAL_CHECKPOINT_DIR") or os.path.expanduser("~/.cache/nlidb/eval_checkpoints")
+        )
+        base = os.path.basename(name.replace("\\", "/"))
+        path = os.path.realpath(os.path.join(directory, base))
+        if base in ("", ".", "..") or os.path.dirname(path) != directory:
+            raise ValueError(f"Invalid checkpoint name: {name!r}")
+        return path
+
+    def load_checkpoint(self) -> dict[int, dict]:
+        """
+        Returns the successfully evaluated entries of the checkpoint file by question id.
+        Failed entries are evaluated again.
+        """
+        path = self.checkpoint
+        if not path or not os.path.exists(path):
+            return {}
+        finished = {}
+        with open(path) as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partially written last line of an interrupted run
+                if result.get("status") == 200:
+                    finished[result["request"]["question_id"]] = result
+        return finished
+
+    @staticmethod
+    def category(result: dict) -> str:
+        if result.get("status") != 200:
+            return "failed"
+        return "valid" if result.get("response", {}).get("valid", False) else "invalid"
+
+    def record(self, result: dict):
+        self.summary[f"{self.category(result)}_requests"] += 1
+
+    async def evaluate(self, request_data: dict) -> dict:
+        try:
+            response_data = await infer_and_compare(TestRequest(**{**request_data, "model": self.request.model, "cache": self.request.cache}))
+            return {
+                "request": request_data,
+                "response": response_data,
+                "status": 200
+            }
+        except Exception as e:
+            return {
+                "request": request_data,
+                "error": str(e),
+                "status": 500
+            }
+
+    async def run(self) -> AsyncIterator[dict]:
+        test_requests = self.load_requests()
+        finished = self.load_checkpoint()
+        self.summary["total_requests"] = len(test_requests)
+
+        pending = asyncio.Queue()
+        for request_data in test_requests:
+            if request_data["question_id"] in finished:
+                self.resumed.append(finished[request_data["question_id"]])
+                self.record(self.resumed[-1])
+                self.summary["resumed_requests"] += 1
+            else:
+                pending.put_nowait(request_data)
+        pending_count = pending.qsize()
+
+        results = asyncio.Queue()
+
+        async def worker():
+            while not pending.empty():
+                await results.put(await self.evaluate(pending.get_nowait()))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, pending_count))]
+        if self.checkpoint:
+            os.makedirs(os.path.dirname(self.checkpoint), exist_ok=True)
+        checkpoint = open(self.checkpoint, "a") if self.checkpoint else None
+        try:
+            for _ in range(pending_count):
+                result = await results.get()
+                self.record(result)
+                if checkpoint:
+                    checkpoint.write(json.dumps(result, default=json_default) + "\n")
+                    checkpoint.flush()
+                yield result
+        finally:
+            # Stop in-flight evaluations when the client goes away
+            for task in workers:
+                task.cancel()
+            if checkpoint:
+                checkpoint.close()
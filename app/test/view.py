@@ -1,174 +1,60 @@
 from app.test import router
-from app.test.model import TestRequest
-from app.generation.model import NLQRequest
+from app.test.model import TestRequest, BulkTestRequest
+from app.test.service import infer_and_compare, BulkEvaluation
+from app.db.service import encode_event
 from fastapi import HTTPException
-from app.test import router
-from pathlib import Path
-import json
-import asyncio
-import httpx
+from fastapi.responses import StreamingResponse
 
 @router.post("/single")
 async def test_infer_and_compare(request: TestRequest):
     """
     Test endpoint to:
-    1. Send NLQRequest to /infer and retrieve the SQL query.
+    1. Generate the SQL query for the question.
     2. Execute both groundtruth and inferred SQL queries on the database.
     3. Compare the results of the queries.
     """
     try:
-        # Step 1: Send NLQRequest to the /infer endpoint
-        async with httpx.AsyncClient() as client:
-            infer_response = await client.post(
-                "http://127.0.0.1:8000/generate/infer",
-                json={
-                    "natural_language_query": request.question,
-                    "clarifications": [request.evidence],
-                    "model": request.model
-                }
-            )
-        
-        if infer_response.status_code != 200:
-            raise HTTPException(
-                status_code=infer_response.status_code,
-                detail=f"Infer endpoint failed: {infer_response.text}"
-            )
-
-        # Extract the inferred SQL query
-        infer_data = infer_response.json()
-        inferred_sql_query = infer_data.get("response").get("final_query")
-        if not inferred_sql_query:
-            raise ValueError("No SQL query was inferred from the /infer endpoint." + json.dumps(infer_data))
-
-        # Step 2: Execute the ground-truth SQL query
-        async with httpx.AsyncClient() as client:
-            groundtruth_response = await client.post(
-                "http://127.0.0.1:8000/db/execute",
-                json={"sql": request.SQL}
-            )
-
-        if groundtruth_response.status_code != 200:
-            raise HTTPException(
-                status_code=groundtruth_response.status_code,
-                detail=f"Groundtruth query failed: {groundtruth_response.text}"
-            )
-
-        groundtruth_result = groundtruth_response.json().get("value")
-
-        # Step 3: Execute the inferred SQL query
-        async with httpx.AsyncClient() as client:
-            inferred_response = await client.post(
-                "http://127.0.0.1:8000/db/execute",
-                json={"sql": inferred_sql_query}
-            )
-
-        if inferred_response.status_code != 200:
-            raise HTTPException(
-                status_code=inferred_response.status_code,
-                detail=f"Inferred query failed: {inferred_response.text}"
-            )
-
-        inferred_result_data = inferred_response.json()
-        inferred_result = inferred_result_data.get("value")
-        inferred_error = inferred_result_data.get("error")
-
-        # Determine if the inferred query is valid
-        valid = inferred_error is None
-
-        # Step 4: Compare the results if the inferred query is valid
-        match = False
-        if valid:
-            match = groundtruth_result == inferred_result
-
-        # Prepare the evaluation result
-        comparison_result = {
-            "valid": valid,  # Whether the inferred query executed successfully
-            "match": match,  # Whether the results match
-            "groundtruth_result": groundtruth_result,
-            "inferred_result": inferred_result if valid else None,  # Result if valid
-            "inferred_sql_query": inferred_sql_query,
-            "error": inferred_error if not valid else None  # Include error if invalid
-        }
-
-        return comparison_result
-
+        return await infer_and_compare(request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 
 @router.post("/bulk")
-async def bulk_infer_and_compare():
+async def bulk_infer_and_compare(request: BulkTestRequest | None = None):
     """
     Bulk endpoint to:
-    1. Read requests from app.test.mini_dev_postgresql.json.
-    2. Send each request to /single endpoint in parallel.
-    3. Return categorized results for valid, invalid, and failed requests.
+    1. Read requests from app.test.mini_dev_postgresql.json, filtered by db_id/difficulty.
+    2. Evaluate each request like the /single endpoint, `concurrency` at a time.
+    3. Return categorized results for valid, invalid, and failed requests, or stream
+       each result as it finishes (`format` "ndjson" or "sse") followed by a summary.
     """
+    request = request or BulkTestRequest()
     try:
-        # Step 1: Read JSON requests from the file
-        file_path = Path("app/test/mini_dev_postgresql.json")
-        if not file_path.exists():
-            raise HTTPException(status_code=404, detail="mini_dev_postgresql.json file not found.")
-        
-        with file_path.open("r") as file:
-            test_requests = json.load(file)
+        evaluation = BulkEvaluation(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Step 2: Prepare requests for the /single endpoint
-        async def send_to_single(request_data):
-            async with httpx.AsyncClient() as client:
-                try:
-                    response = await client.post(
-                        "http://127.0.0.1:8000/test/single",
-                        json=request_data
-                    )
-                    response_data = response.json()
-                    return {
-                        "request": request_data,
-                        "response": response_data,
-                        "status": response.status_code
-                    }
-                except Exception as e:
-                    return {
-                        "request": request_data,
-                        "error": str(e),
-                        "status": 500
-                    }
+    if request.format != "json":
+        async def stream():
+            async for result in evaluation.run():
+                yield encode_event("result", result, request.format)
+            yield encode_event("summary", {"summary": evaluation.summary}, request.format)
 
-        # Step 3: Create asyncio tasks for all requests
-        tasks = [
-            send_to_single(request_data) for request_data in test_requests
-        ]
+        media_type = "text/event-stream" if request.format == "sse" else "application/x-ndjson"
+        return StreamingResponse(stream(), media_type=media_type)
 
-        # Step 4: Execute all tasks in parallel
-        results = await asyncio.gather(*tasks)
-
-        # Step 5: Categorize the results
-        valid_requests = []
-        invalid_requests = []
-        failed_requests = []
-
-        for res in results:
-            if res.get("status") == 200:
-                response = res.get("response", {})
-                if response.get("valid", False):  # Valid SQL query
-                    valid_requests.append(res)
-                else:  # Invalid SQL query
-                    invalid_requests.append(res)
-            else:  # Failed request
-                failed_requests.append(res)
+    try:
+        results = {"valid": [], "invalid": [], "failed": []}
+        async for result in evaluation.run():
+            results[evaluation.category(result)].append(result)
+        for result in evaluation.resumed:
+            results[evaluation.category(result)].append(result)
 
         # Return the categorized results
         return {
-            "total_requests": len(test_requests),
-            "valid_requests": len(valid_requests),
-            "invalid_requests": len(invalid_requests),
-            "failed_requests": len(failed_requests),
-            "results": {
-                "valid": valid_requests,
-                "invalid": invalid_requests,
-                "failed": failed_requests
-            }
+            **evaluation.summary,
+            "results": results
         }
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,59 @@
+import ast
+import json
+import os
+import sys
+import pandas as pd
+
+# Run from the classifiers directory like the training scripts
+sys.path.insert(0, "..")
+from app.classification.bert import BertTableClassifier
+
+model_dir = os.getenv("BERT_TABLE_MODEL_DIR", "./multi_label_model")
+report_path = "./bert_table_classifier_benchmark.md"
+
+data = pd.read_csv("../data/bird/tablenames_dataset.csv")
+with open("../data/bird/processed_tables.json", "r") as file:
+    schema_info = json.load(file)
+with open("../app/test/mini_dev_postgresql.json", "r") as file:
+    benchmark_ids = {item["question_id"] for item in json.load(file)}
+
+# The mini-dev questions, each with the tables of its database as candidates
+test_data = data[data["question_id"].isin(benchmark_ids)]
+database_tables = {
+    db_id: [table.lower() for table in tables]
+    for db_id, tables in schema_info.items()
+}
+queries = [
+    (question, db_id, database_tables[db_id])
+    for question, db_id in zip(test_data["question"], test_data["db_id"])
+]
+gold = [set(ast.literal_eval(tables)) for tables in test_data["table_names"]]
+
+rows = []
+predictions = {}
+for quantize in (False, True):
+    classifier = BertTableClassifier(model_dir, quantize=quantize)
+    predictions[quantize] = [set(tables) for tables, _ in classifier.predict(queries)]
+    exact_match = sum(p == g for p, g in zip(predictions[quantize], gold)) / len(gold)
+    for result in classifier.benchmark(queries):
+        rows.append({**result, "exact_match": exact_match})
+    print(f"{'int8' if quantize else 'fp32'} done")
+
+agreement = sum(a == b for a, b in zip(predictions[False], predictions[True])) / len(queries)
+
+lines = [
+    f"# BERT table classifier on CPU ({len(queries)} mini-dev questions, {os.cpu_count()} CPUs)",
+    "",
+    "| weights | batch size | p50 ms/batch | p95 ms/batch | queries/s | exact match |",
+    "|---|---|---|---|---|---|",
+]
+for row in rows:
+    lines.append(
+        f"| {'int8' if row['quantized'] else 'fp32'} | {row['batch_size']} | {row['p50_ms']:.1f} "
+        f"| {row['p95_ms']:.1f} | {row['queries_per_second']:.1f} | {row['exact_match']:.3f} |"
+    )
+lines += ["", f"fp32 and int8 predict the same table set for {agreement:.1%} of the questions."]
+
+with open(report_path, "w") as file:
+    file.write("\n".join(lines) + "\n")
+print("\n".join(lines))
@@ -1,83 +1,143 @@
+import ast
+import hashlib
+import json
+import os
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification
-from torch.utils.data import Dataset, DataLoader
+from transformers import BertTokenizerFast, BertForSequenceClassification
+from torch.utils.data import Dataset, DataLoader, Sampler
+from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.model_selection import train_test_split
-import pandas as pd
-import json
-
-# Load dataset from CSV file
-data_df = pd.read_csv("../data/bird/tablenames_dataset.csv")
 
-# Load schema information from JSON file
-with open("../data/bird/processed_tables.json", "r") as file:
-    schema_info = json.load(file)
-
-# Binarize the table names (multi-label encoding)
-mlb = MultiLabelBinarizer()
-data_df['table_names_encoded'] = list(mlb.fit_transform(data_df['table_names'].apply(eval)))
-
-# Split data into train and test
-train_data, test_data = train_test_split(data_df, test_size=0.2, random_state=42)
-
-# Custom Dataset class
-class TablePredictionDataset(Dataset):
-    def __init__(self, data, tokenizer, max_len, mlb):
-        self.data = data
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-        self.mlb = mlb
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        question = self.data.iloc[idx]['question']
-        db_id = self.data.iloc[idx]['db_id']
-        input_text = f"{question} [SEP] {db_id}"
-        labels = torch.tensor(self.data.iloc[idx]['table_names_encoded'], dtype=torch.float)
-
-        inputs = self.tokenizer(
-            input_text,
-            padding='max_length',
-            truncation=True,
-            max_length=self.max_len,
-            return_tensors="pt"
-        )
-
-        return {
-            'input_ids': inputs['input_ids'].squeeze(0),
-            'attention_mask': inputs['attention_mask'].squeeze(0),
-            'labels': labels
-        }
+DATA_DIR = Path(__file__).resolve().parent.parent / "data" / "bird"
+CACHE_DIR = Path(__file__).resolve().parent / ".token_cache"
+BENCHMARK_PATH = Path(__file__).resolve().parent.parent / "app" / "test" / "mini_dev_postgresql.json"
 
 # Hyperparameters
 MAX_LEN = 128
 BATCH_SIZE = 8
 EPOCHS = 3
 LEARNING_RATE = 2e-5
+NUM_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def load_data(path=DATA_DIR / "tablenames_dataset.csv"):
+    """Load the questions with their parsed table names."""
+    data_df = pd.read_csv(path)
+    data_df['tables'] = data_df['table_names'].apply(ast.literal_eval)
+    return data_df
+
+
+def input_texts(data_df):
+    return [f"{question} [SEP] {db_id}" for question, db_id in zip(data_df['question'], data_df['db_id'])]
+
+
+def tokenize_cached(texts, tokenizer, max_len=MAX_LEN, cache_dir=CACHE_DIR):
+    """
+    Tokenize every text once, without padding, and cache the token ids on disk.
+    Returns the paths of the flat int32 token id array and of the per-text offsets into it.
+    """
+    key = hashlib.sha256(
+        "\n".join([tokenizer.name_or_path, str(len(tokenizer)), str(max_len), *texts]).encode()
+    ).hexdigest()[:16]
+    ids_path = Path(cache_dir) / f"{key}.ids.npy"
+    offsets_path = Path(cache_dir) / f"{key}.offsets.npy"
+    if not (ids_path.exists() and offsets_path.exists()):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        encodings = tokenizer(texts, truncation=True, max_length=max_len)['input_ids']
+        offsets = np.zeros(len(encodings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(ids) for ids in encodings])
+        ids = np.fromiter((token for ids in encodings for token in ids), dtype=np.int32, count=offsets[-1])
+        # Write under temporary names so an interrupted run never leaves a partial cache
+        for path, array in ((ids_path, ids), (offsets_path, offsets)):
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+    return ids_path, offsets_path
+
+
+class TablePredictionDataset(Dataset):
+    """
+    Pre-tokenized questions. Token ids are memory-mapped, so DataLoader workers share
+    the page cache instead of copying them, and items are plain array slices.
+    """
+    def __init__(self, ids_path, offsets_path, labels, indices=None):
+        self.ids_path = ids_path
+        self.offsets = np.load(offsets_path)
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+        self.ids = None
+
+    def __len__(self):
+        return len(self.indices)
 
-# Tokenizer and Model
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-model = BertForSequenceClassification.from_pretrained(
-    'bert-base-uncased',
-    num_labels=len(mlb.classes_),
-    problem_type="multi_label_classification"
-)
+    @property
+    def lengths(self):
+        return (self.offsets[self.indices + 1] - self.offsets[self.indices]).tolist()
 
-# Datasets and DataLoaders
-train_dataset = TablePredictionDataset(train_data, tokenizer, MAX_LEN, mlb)
-test_dataset = TablePredictionDataset(test_data, tokenizer, MAX_LEN, mlb)
+    def __getitem__(self, idx):
+        if self.ids is None:
+            # Opened lazily so each worker maps the file itself
+            self.ids = np.load(self.ids_path, mmap_mode="r")
+        row = self.indices[idx]
+        return self.ids[self.offsets[row]:self.offsets[row + 1]], self.labels[row]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of similar length: indices are shuffled, split into buckets of
+    `bucket_batches` batches, sorted by length within a bucket, and the batches are shuffled.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=50, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.generator = np.random.default_rng(seed)
 
-train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-test_loader = DataLoader(test_dataset, batch_size=BATCH_SIZE)
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.generator.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            self.generator.shuffle(batches)
+        return iter(batches)
+
+
+def collate(batch, pad_token_id=0):
+    """Pad a batch to its longest sequence."""
+    max_len = max(len(ids) for ids, _ in batch)
+    input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+    for i, (ids, _) in enumerate(batch):
+        input_ids[i, :len(ids)] = torch.from_numpy(np.asarray(ids, dtype=np.int64))
+        attention_mask[i, :len(ids)] = 1
+    labels = torch.from_numpy(np.stack([labels for _, labels in batch]))
+    return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+
+
+def make_loader(dataset, tokenizer, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS):
+    return DataLoader(
+        dataset,
+        batch_sampler=LengthBucketBatchSampler(dataset.lengths, batch_size, shuffle=shuffle),
+        collate_fn=partial(collate, pad_token_id=tokenizer.pad_token_id),
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+    )
 
-# Optimizer and Loss Function
-optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE)
-criterion = torch.nn.BCEWithLogitsLoss()
 
 # Training Loop
-def train_model(model, data_loader, optimizer, criterion, device):
+def train_model(model, data_loader, optimizer, device):
     model.train()
     total_loss = 0
 
@@ -98,14 +158,15 @@ def train_model(model, data_loader, optimizer, criterion, device):
 
     return total_loss / len(data_loader)
 
+
 # Evaluation Loop
-def evaluate_model(model, data_loader, criterion, device):
+def evaluate_model(model, data_loader, device):
     model.eval()
     total_loss = 0
     all_preds = []
     all_labels = []
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch in data_loader:
             input_ids = batch['input_ids'].to(device)
             attention_mask = batch['attention_mask'].to(device)
@@ -113,29 +174,71 @@ def evaluate_model(model, data_loader, criterion, device):
 
             outputs = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
 
-            loss = outputs.loss
-            total_loss += loss.item()
-
-            preds = torch.sigmoid(outputs.logits).cpu()
-            all_preds.append(preds)
+            total_loss += outputs.loss.item()
+            all_preds.append(torch.sigmoid(outputs.logits).cpu())
             all_labels.append(labels.cpu())
 
     return total_loss / len(data_loader), torch.cat(all_preds), torch.cat(all_labels)
 
-# Training the model
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
 
-for epoch in range(EPOCHS):
-    train_loss = train_model(model, train_loader, optimizer, criterion, device)
-    val_loss, preds, labels = evaluate_model(model, test_loader, criterion, device)
+def metrics(preds, labels, threshold=0.5):
+    preds = (preds.numpy() >= threshold).astype(int)
+    labels = labels.numpy()
+    accuracy = accuracy_score(labels, preds)
+    precision, recall, f1, _ = precision_recall_fscore_support(labels, preds, average='micro')
+    return accuracy, precision, recall, f1
+
+
+def main(output_dir="./multi_label_model"):
+    data_df = load_data()
+
+    # Binarize the table names (multi-label encoding)
+    mlb = MultiLabelBinarizer()
+    labels = mlb.fit_transform(data_df['tables'])
+
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    ids_path, offsets_path = tokenize_cached(input_texts(data_df), tokenizer)
+
+    # The mini-dev benchmark questions are held out so /test/bulk and the benchmark stay a fair
+    # evaluation; the validation split comes from the remaining questions
+    with open(BENCHMARK_PATH, "r") as file:
+        benchmark_ids = {item["question_id"] for item in json.load(file)}
+    candidates = np.flatnonzero(~data_df['question_id'].isin(benchmark_ids).to_numpy())
+    train_idx, test_idx = train_test_split(candidates, test_size=0.2, random_state=42)
+    train_dataset = TablePredictionDataset(ids_path, offsets_path, labels, train_idx)
+    test_dataset = TablePredictionDataset(ids_path, offsets_path, labels, test_idx)
+
+    train_loader = make_loader(train_dataset, tokenizer, shuffle=True)
+    test_loader = make_loader(test_dataset, tokenizer)
+
+    model = BertForSequenceClassification.from_pretrained(
+        'bert-base-uncased',
+        num_labels=len(mlb.classes_),
+        problem_type="multi_label_classification",
+        # Saved with the model so app/classification/bert.py can map logits to table names
+        id2label={idx: label for idx, label in enumerate(mlb.classes_)},
+        label2id={label: idx for idx, label in enumerate(mlb.classes_)}
+    )
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+
+    for epoch in range(EPOCHS):
+        train_loss = train_model(model, train_loader, optimizer, device)
+        val_loss, preds, val_labels = evaluate_model(model, test_loader, device)
+
+        print(f"Epoch {epoch + 1}/{EPOCHS}")
+        print(f"Train Loss: {train_loss:.4f}")
+        print(f"Validation Loss: {val_loss:.4f}")
+
+    # Save the model
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
 
-    print(f"Epoch {epoch + 1}/{EPOCHS}")
-    print(f"Train Loss: {train_loss:.4f}")
-    print(f"Validation Loss: {val_loss:.4f}")
+    print("Model training complete and saved!")
 
-# Save the model
-model.save_pretrained("./multi_label_model")
-tokenizer.save_pretrained("./multi_label_model")
 
-print("Model training complete and saved!")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import ast
+import json
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+file_path = '../data/bird/tablenames_dataset.csv'
+benchmark_path = '../app/test/mini_dev_postgresql.json'
+data = pd.read_csv(file_path)
+
+# Each label is the whole table set of a question within its database ("db:table1,table2"),
+# so predict_proba gives a calibrated confidence for the complete answer.
+data['tables'] = data['table_names'].apply(ast.literal_eval)
+data = data[data['tables'].map(len) > 0]
+data['label'] = [
+    db_id + ":" + ",".join(sorted(tables))
+    for db_id, tables in zip(data['db_id'], data['tables'])
+]
+
+# The mini-dev benchmark questions are held out so /test/bulk stays a fair evaluation
+with open(benchmark_path, "r") as file:
+    benchmark_ids = {item["question_id"] for item in json.load(file)}
+is_benchmark = data['question_id'].isin(benchmark_ids)
+train_data, test_data = data[~is_benchmark], data[is_benchmark]
+
+unique_labels = sorted(train_data['label'].unique().tolist())
+label_mapping = {label: idx for idx, label in enumerate(unique_labels)}
+
+tfidf_vectorizer = TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=2)
+X_train_tfidf = tfidf_vectorizer.fit_transform(train_data['question'])
+
+logistic_model = LogisticRegression(max_iter=2000, C=10, random_state=42)
+logistic_model.fit(X_train_tfidf, train_data['label'].map(label_mapping))
+
+print("Model training complete!")
+
+
+def predict_tables(question, db_id):
+    """Most likely table set of the database and its probability among the database's table sets."""
+    probabilities = logistic_model.predict_proba(tfidf_vectorizer.transform([question]))[0]
+    labels = [unique_labels[idx] for idx in logistic_model.classes_]
+    candidates = [(p, label) for p, label in zip(probabilities, labels) if label.startswith(db_id + ":")]
+    total = sum(p for p, _ in candidates)
+    probability, label = max(candidates)
+    return set(label.split(":", 1)[1].split(",")), probability / total
+
+
+# Exact table-set accuracy on the benchmark, overall and above confidence thresholds
+results = []
+for question, db_id, tables in zip(test_data['question'], test_data['db_id'], test_data['tables']):
+    predicted, confidence = predict_tables(question, db_id)
+    results.append((predicted == set(tables), confidence))
+print(f"Exact match: {np.mean([correct for correct, _ in results]):.3f} on {len(results)} questions")
+for min_confidence in (0.5, 0.6, 0.7, 0.8, 0.9):
+    confident = [correct for correct, confidence in results if confidence >= min_confidence]
+    if confident:
+        print(
+            f"Confidence >= {min_confidence}: {len(confident) / len(results):.0%} of questions, "
+            f"exact match {np.mean(confident):.3f}"
+        )
+
+joblib.dump(logistic_model, './table_logistic_model.pkl')
+joblib.dump(tfidf_vectorizer, './table_tfidf_vectorizer.pkl')
+joblib.dump(label_mapping, './table_label_mapping.pkl')
+
+print("Model, vectorizer, and label mapping saved!")
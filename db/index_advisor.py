@@ -0,0 +1,363 @@
+"""
+Index advisor for the BIRD workload. Run it from the repository root as a module,
+`python -m db.index_advisor`, so that `db.migrate` can be imported.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+from collections import Counter, defaultdict
+from pathlib import Path
+import psycopg2
+from psycopg2 import sql
+from db.migrate import pg_settings
+
+WORKLOAD_PATH = Path(__file__).resolve().parent.parent / "app" / "test" / "mini_dev_postgresql.json"
+
+# Read queries, as DECLARABLE_QUERY in app/db/service.py: EXPLAIN ANALYZE executes its statement
+READ_QUERY = re.compile(r"^[\s(]*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+
+# Clauses whose columns an index can serve
+CLAUSES = ("where", "join", "order")
+
+TOKEN = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[A-Za-z_][A-Za-z0-9_$]*|\d+(?:\.\d+)?|<>|!=|<=|>=|::|\S"""
+)
+# Keywords that end a table reference or change the clause
+KEYWORDS = {
+    "select", "from", "join", "on", "where", "group", "order", "having", "limit", "offset", "union",
+    "except", "intersect", "inner", "left", "right", "full", "outer", "cross", "natural", "using", "as",
+    "by", "and", "or", "not", "case", "when", "then", "else", "end", "asc", "desc", "nulls", "with",
+}
+
+
+def load_workload(workload_path=WORKLOAD_PATH, checkpoints=()):
+    """
+    Queries by db_id as (label, SQL) pairs: the gold SQL of the benchmark and the valid inferred
+    read queries logged in /test/bulk checkpoint files.
+    """
+    workload = defaultdict(list)
+    with open(workload_path, "r") as file:
+        for item in json.load(file):
+            workload[item["db_id"]].append((f"gold {item['question_id']}", item["SQL"]))
+    for checkpoint in checkpoints:
+        with open(checkpoint, "r") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                inferred = (result.get("response") or {}).get("inferred_sql_query")
+                if inferred and result.get("response", {}).get("valid") and READ_QUERY.match(inferred):
+                    request = result["request"]
+                    workload[request["db_id"]].append((f"inferred {request['question_id']}", inferred))
+    return workload
+
+
+def identifier(token):
+    """Name of an identifier token, None for literals and symbols."""
+    if token.startswith('"'):
+        return token[1:-1].replace('""', '"')
+    if token[0].isalpha() or token[0] == "_":
+        return token
+    return None
+
+
+def column_usage(query, schema):
+    """
+    The (table, column, clause) references of a query, with clause one of `CLAUSES`.
+
+    Table aliases are collected from the FROM and JOIN clauses of the whole query, a qualified
+    column is resolved through its alias and an unqualified one to the only table of the query
+    that has it. Names are matched case-insensitively to `schema`, {table: {column}} in lowercase.
+    """
+    tokens = TOKEN.findall(query)
+    lowered = [token.lower() for token in tokens]
+
+    # Pass 1: table references, `table [AS] alias`
+    aliases = defaultdict(set)
+    tables = set()
+    for i, token in enumerate(lowered):
+        if token not in ("from", "join") and not (token == "," and i and _in_from(lowered, i)):
+            continue
+        name = identifier(tokens[i + 1]) if i + 1 < len(tokens) else None
+        if not name or name.lower() not in schema:
+            continue
+        table = name.lower()
+        tables.add(table)
+        aliases[table].add(table)
+        j = i + 2
+        if j < len(tokens) and lowered[j] == "as":
+            j += 1
+        alias = identifier(tokens[j]) if j < len(tokens) else None
+        if alias and alias.lower() not in KEYWORDS:
+            aliases[alias.lower()].add(table)
+
+    # Pass 2: column references by clause
+    usage = set()
+    clause = None
+    for i, token in enumerate(lowered):
+        if token == "where":
+            clause = "where"
+        elif token == "on":
+            clause = "join"
+        elif token == "order" and i + 1 < len(lowered) and lowered[i + 1] == "by":
+            clause = "order"
+        elif token in ("select", "from", "join", "group", "having", "limit", "union", "except", "intersect"):
+            clause = None
+        if clause is None or token in KEYWORDS:
+            continue
+        name = identifier(tokens[i])
+        if not name or (i and lowered[i - 1] == "."):
+            continue
+        column = name.lower()
+        if i + 2 < len(tokens) and lowered[i + 1] == ".":
+            # alias.column
+            column = (identifier(tokens[i + 2]) or "").lower()
+            candidates = aliases.get(name.lower(), set())
+        elif i + 1 < len(tokens) and lowered[i + 1] == "(":
+            continue  # function call
+        else:
+            candidates = tables
+        matches = [table for table in candidates if column in schema[table]]
+        if len(matches) == 1:
+            usage.add((matches[0], column, clause))
+    return usage
+
+
+def _in_from(lowered, i):
+    """Whether the comma at position i separates table references of a FROM clause."""
+    depth = 0
+    for token in reversed(lowered[:i]):
+        if token == ")":
+            depth += 1
+        elif token == "(":
+            if not depth:
+                return False
+            depth -= 1
+        elif not depth and token in ("select", "where", "on", "group", "order", "having"):
+            return False
+        elif not depth and token == "from":
+            return True
+    return False
+
+
+class IndexAdvisor:
+    """
+    Proposes single-column indexes for a database from the columns its workload filters,
+    joins and sorts on, and keeps the ones that make the workload faster under EXPLAIN ANALYZE.
+    Queries are timed on a read-only connection whose transactions are rolled back; only the
+    index DDL runs on the autocommit connection.
+    """
+    def __init__(self, db_name, pg, runs=3, min_speedup=1.1, min_rows=1000, statement_timeout_ms=30000):
+        self.db_name = db_name
+        self.runs = runs
+        self.min_speedup = min_speedup
+        self.min_rows = min_rows
+        self.conn = psycopg2.connect(
+            dbname=db_name, options=f"-c statement_timeout={statement_timeout_ms}", **pg
+        )
+        self.conn.autocommit = True
+        self.read_conn = psycopg2.connect(
+            dbname=db_name,
+            options=f"-c statement_timeout={statement_timeout_ms} -c default_transaction_read_only=on",
+            **pg,
+        )
+        self.names = {}  # lowercase table/column -> name in the database
+        self.schema = defaultdict(set)
+        self.rows = {}
+        self.indexed = set()
+        self.load_catalog()
+
+    def close(self):
+        self.read_conn.close()
+        self.conn.close()
+
+    def load_catalog(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT c.relname, a.attname, c.reltuples
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                WHERE n.nspname = 'public' AND c.relkind = 'r';
+            """)
+            for table, column, rows in cursor.fetchall():
+                self.names[table.lower()] = table
+                self.names[(table.lower(), column.lower())] = column
+                self.schema[table.lower()].add(column.lower())
+                self.rows[table.lower()] = rows
+
+            # Columns that already lead an index
+            cursor.execute("""
+                SELECT c.relname, a.attname
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+                WHERE n.nspname = 'public';
+            """)
+            self.indexed = {(table.lower(), column.lower()) for table, column in cursor.fetchall()}
+
+    def candidates(self, queries, max_candidates=10):
+        """
+        Unindexed columns of tables with at least `min_rows` rows, by the number of queries using them.
+
+        Returns:
+            list[dict]: table, column, usage per clause and the labels of the queries using it.
+        """
+        usage = defaultdict(Counter)
+        users = defaultdict(set)
+        for label, query in queries:
+            for table, column, clause in column_usage(query, self.schema):
+                usage[table, column][clause] += 1
+                users[table, column].add(label)
+        ranked = sorted(
+            (key for key in usage if key not in self.indexed and self.rows.get(key[0], 0) >= self.min_rows),
+            key=lambda key: (-len(users[key]), key),
+        )
+        return [
+            {"table": table, "column": column, "usage": dict(usage[table, column]), "queries": sorted(users[table, column])}
+            for table, column in ranked[:max_candidates]
+        ]
+
+    def execution_time(self, query):
+        """Median EXPLAIN ANALYZE execution time of a query in ms after a warm-up run, None if it fails."""
+        times = []
+        try:
+            with self.read_conn.cursor() as cursor:
+                for run in range(self.runs + 1):
+                    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    if run:
+                        times.append(plan[0]["Execution Time"])
+        except psycopg2.Error as e:
+            print(f"Skipping query in {self.db_name}: {str(e).strip()}")
+            return None
+        finally:
+            self.read_conn.rollback()
+        return statistics.median(times)
+
+    def benchmark(self, candidate, queries, apply=True):
+        """
+        Times the queries using a candidate column before and after indexing it.
+        The index is kept if `apply` is set and the queries got `min_speedup` times faster overall.
+        """
+        table, column = self.names[candidate["table"]], self.names[candidate["table"], candidate["column"]]
+        index = f"advisor_{table}_{column}_idx"[:63]
+        timed = [(label, query) for label, query in queries if label in set(candidate["queries"])]
+        before = {label: self.execution_time(query) for label, query in timed}
+
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql.SQL("CREATE INDEX {index} ON {table} ({column});").format(
+                index=sql.Identifier(index), table=sql.Identifier(table), column=sql.Identifier(column)
+            ))
+            cursor.execute(sql.SQL("ANALYZE {table};").format(table=sql.Identifier(table)))
+        after = {label: self.execution_time(query) for label, query in timed if before[label] is not None}
+
+        per_query = [
+            {"query": label, "before_ms": before[label], "after_ms": after[label]}
+            for label, _ in timed if before[label] is not None and after.get(label) is not None
+        ]
+        total_before = sum(result["before_ms"] for result in per_query)
+        total_after = sum(result["after_ms"] for result in per_query)
+        speedup = total_before / total_after if total_after else 1.0
+        applied = apply and bool(per_query) and speedup >= self.min_speedup
+        if applied:
+            self.indexed.add((candidate["table"], candidate["column"]))
+        else:
+            with self.conn.cursor() as cursor:
+                cursor.execute(sql.SQL("DROP INDEX {index};").format(index=sql.Identifier(index)))
+        return {
+            **candidate,
+            "index": index,
+            "before_ms": total_before,
+            "after_ms": total_after,
+            "speedup": speedup,
+            "applied": applied,
+            "per_query": per_query,
+        }
+
+    def run(self, queries, max_candidates=10, apply=True):
+        results = []
+        for candidate in self.candidates(queries, max_candidates):
+            result = self.benchmark(candidate, queries, apply)
+            print(
+                f"{self.db_name}.{result['table']}.{result['column']}: {len(result['per_query'])} queries, "
+                f"{result['before_ms']:.1f}ms -> {result['after_ms']:.1f}ms ({result['speedup']:.2f}x)"
+                f"{', applied' if result['applied'] else ''}"
+            )
+            results.append(result)
+        return results
+
+
+def write_report(results, path):
+    """Markdown report of the benchmarked candidates and the per-query speedups of the applied indexes."""
+    lines = ["# Index advisor report", ""]
+    for db_name, db_results in results.items():
+        lines += [
+            f"## {db_name}", "",
+            "| index | where | join | order by | queries | before (ms) | after (ms) | speedup | applied |",
+            "|---|---|---|---|---|---|---|---|---|",
+        ]
+        for result in db_results:
+            usage = result["usage"]
+            lines.append(
+                f"| {result['table']}({result['column']}) | {usage.get('where', 0)} | {usage.get('join', 0)} "
+                f"| {usage.get('order', 0)} | {len(result['per_query'])} | {result['before_ms']:.1f} "
+                f"| {result['after_ms']:.1f} | {result['speedup']:.2f}x | {'yes' if result['applied'] else 'no'} |"
+            )
+        applied = [result for result in db_results if result["applied"]]
+        if applied:
+            lines += ["", "| query | index | before (ms) | after (ms) | speedup |", "|---|---|---|---|---|"]
+            for result in applied:
+                for query in sorted(result["per_query"], key=lambda q: q["after_ms"] / max(q["before_ms"], 1e-9)):
+                    lines.append(
+                        f"| {query['query']} | {result['index']} | {query['before_ms']:.2f} | {query['after_ms']:.2f} "
+                        f"| {query['before_ms'] / max(query['after_ms'], 1e-9):.2f}x |"
+                    )
+        lines.append("")
+    with open(path, "w") as file:
+        file.write("\n".join(lines))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m db.index_advisor",
+        description="Propose, benchmark and apply indexes for the BIRD workload. Run from the repository root.",
+    )
+    parser.add_argument("--databases", nargs="*", help="Only advise these databases (default: all in the workload)")
+    parser.add_argument("--workload", default=WORKLOAD_PATH, help="Benchmark JSON with db_id and SQL")
+    parser.add_argument("--checkpoint", nargs="*", default=[], help="/test/bulk checkpoint files with inferred SQL")
+    parser.add_argument("--max-candidates", type=int, default=10, help="Candidates benchmarked per database")
+    parser.add_argument("--runs", type=int, default=3, help="Timed EXPLAIN ANALYZE runs per query")
+    parser.add_argument("--min-speedup", type=float, default=1.1, help="Workload speedup an index must reach")
+    parser.add_argument("--min-rows", type=int, default=1000, help="Skip tables with fewer rows")
+    parser.add_argument("--dry-run", action="store_true", help="Benchmark only, drop every candidate index")
+    parser.add_argument("--report", default="index_advisor_report.md")
+    args = parser.parse_args(argv)
+
+    workload = load_workload(args.workload, args.checkpoint)
+    pg = pg_settings()
+    results = {}
+    for db_name in sorted(args.databases or workload):
+        try:
+            advisor = IndexAdvisor(db_name, pg, args.runs, args.min_speedup, args.min_rows)
+        except psycopg2.Error as e:
+            print(f"Skipping database {db_name}: {str(e).strip()}")
+            continue
+        try:
+            results[db_name] = advisor.run(workload[db_name], args.max_candidates, apply=not args.dry_run)
+        finally:
+            advisor.close()
+
+    write_report(results, args.report)
+    print(f"Report written to {os.path.abspath(args.report)}")
+
+
+if __name__ == "__main__":
+    main()
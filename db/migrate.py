@@ -1,159 +1,504 @@
+import argparse
+import json
 import os
+import re
 import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 import psycopg2
 from psycopg2 import sql
 
-# PostgreSQL connection parameters
+# PostgreSQL connection parameters, overridable with PG_USER / PG_HOST / PG_PORT / PG_PASSWORD
 PG_USER = "postgres"
 PG_HOST = "localhost"
 PG_PORT = 5432
 PG_PASSWORD = ""  # Add password if required
 
-# Directory containing SQLite files
-SQLITE_DIR = os.path.expanduser("/Users/muratbayrktr/Desktop/nlidb/mini_dev/llm/mini_dev_data/dev_databases")
+# Rows read from SQLite per fetchmany call and written per COPY chunk
+CHUNK_SIZE = 10000
 
-# Connect to PostgreSQL
-pg_conn = psycopg2.connect(
-    dbname="postgres", user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT
-)
-pg_conn.autocommit = True
-pg_cursor = pg_conn.cursor()
+# Primary and foreign keys of the BIRD dev databases, used where the SQLite schema declares none
+DEV_TABLES_PATH = Path(__file__).resolve().parent.parent / "app" / "dev_tables.json"
 
-def drop_and_create_database(db_name):
+
+def pg_settings(user=None, host=None, port=None, password=None):
+    """PostgreSQL connection parameters, from the arguments, the environment or the defaults above."""
+    return {
+        "user": user or os.getenv("PG_USER", PG_USER),
+        "host": host or os.getenv("PG_HOST", PG_HOST),
+        "port": int(port or os.getenv("PG_PORT", PG_PORT)),
+        "password": password if password is not None else os.getenv("PG_PASSWORD", PG_PASSWORD),
+    }
+
+
+def drop_and_create_database(db_name, pg):
     """Drop and recreate a PostgreSQL database."""
+    pg_conn = psycopg2.connect(dbname="postgres", **pg)
+    pg_conn.autocommit = True
     try:
-        print(f"Dropping database {db_name} if it exists...")
-        
-        # Terminate active connections to the database
-        pg_cursor.execute(
-            sql.SQL("""
-                SELECT pg_terminate_backend(pg_stat_activity.pid)
-                FROM pg_stat_activity
-                WHERE pg_stat_activity.datname = {db_name}
-                AND pid <> pg_backend_pid();
-            """).format(db_name=sql.Literal(db_name))
-        )
+        with pg_conn.cursor() as pg_cursor:
+            print(f"Dropping database {db_name} if it exists...")
 
-        # Drop the database
-        pg_cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {db_name};").format(db_name=sql.Identifier(db_name)))
+            # Terminate active connections to the database
+            pg_cursor.execute(
+                sql.SQL("""
+                    SELECT pg_terminate_backend(pg_stat_activity.pid)
+                    FROM pg_stat_activity
+                    WHERE pg_stat_activity.datname = {db_name}
+                    AND pid <> pg_backend_pid();
+                """).format(db_name=sql.Literal(db_name))
+            )
 
-        print(f"Creating database {db_name}...")
-        pg_cursor.execute(sql.SQL("CREATE DATABASE {db_name};").format(db_name=sql.Identifier(db_name)))
-    except Exception as e:
-        print(f"Error creating database {db_name}: {e}")
+            # Drop the database
+            pg_cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {db_name};").format(db_name=sql.Identifier(db_name)))
+
+            print(f"Creating database {db_name}...")
+            pg_cursor.execute(sql.SQL("CREATE DATABASE {db_name};").format(db_name=sql.Identifier(db_name)))
+    finally:
+        pg_conn.close()
+
+
+def sqlite_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
 
-def migrate_sqlite_to_postgres(sqlite_file, db_name):
-    """Migrate data from SQLite to PostgreSQL."""
+
+def read_schema(sqlite_file):
+    """
+    Tables of a SQLite database with their (column name, declared type) pairs, primary keys
+    and foreign keys as (table, columns, referenced table, referenced columns).
+    """
+    sqlite_conn = sqlite3.connect(sqlite_file)
     try:
-        # Connect to the SQLite database
-        sqlite_conn = sqlite3.connect(sqlite_file)
-        sqlite_cursor = sqlite_conn.cursor()
+        table_names = [
+            name for (name,) in sqlite_conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+            )
+        ]
+        tables, primary_keys, foreign_keys = {}, {}, []
+        for table in table_names:
+            table_info = [col for col in sqlite_conn.execute(f"PRAGMA table_info({sqlite_identifier(table)});") if col[1]]
+            tables[table] = [(col[1], col[2] or "") for col in table_info]
+            # col[5] is the position of the column in the primary key, 0 if it is not part of it
+            primary_key = [col[1] for col in sorted(table_info, key=lambda col: col[5]) if col[5]]
+            if primary_key:
+                primary_keys[table] = primary_key
 
-        # Connect to the newly created PostgreSQL database
-        target_pg_conn = psycopg2.connect(
-            dbname=db_name, user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT
-        )
-        target_pg_cursor = target_pg_conn.cursor()
+        for table in table_names:
+            references = {}
+            for fk_id, _, ref_table, from_column, to_column, *_ in sqlite_conn.execute(
+                f"PRAGMA foreign_key_list({sqlite_identifier(table)});"
+            ):
+                references.setdefault(fk_id, (ref_table, []))[1].append((from_column, to_column))
+            for ref_table, pairs in references.values():
+                from_columns = [from_column for from_column, _ in pairs]
+                # A reference without target columns points to the primary key
+                to_columns = [to_column for _, to_column in pairs]
+                if None in to_columns:
+                    to_columns = primary_keys.get(ref_table, [])
+                if ref_table in tables and len(to_columns) == len(from_columns):
+                    foreign_keys.append((table, from_columns, ref_table, to_columns))
+        return tables, primary_keys, foreign_keys
+    finally:
+        sqlite_conn.close()
 
-        # Get the list of tables in SQLite
-        sqlite_cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = sqlite_cursor.fetchall()
 
-        if not tables:
-            print(f"No tables found in SQLite database {sqlite_file}. Skipping.")
-            return
+def load_dev_tables(path=DEV_TABLES_PATH):
+    """BIRD table metadata (app/dev_tables.json) by db_id, empty if the file does not exist."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return {schema["db_id"]: schema for schema in json.load(file)}
 
-        for table in tables:
-            try:
-                table_name = table[0]
-                print(f"Migrating table {table_name}...")
-
-                # Fetch table schema from SQLite
-                sqlite_cursor.execute(f"PRAGMA table_info({table_name});")
-                columns = sqlite_cursor.fetchall()
-
-                # Debugging: Print the raw columns
-                print(f"Schema for table {table_name}: {columns}")
-
-                # Skip tables with no columns
-                if not columns:
-                    print(f"Skipping table {table_name}: No columns found.")
-                    continue
-
-                # Validate and extract column definitions
-                column_definitions = [
-                    f"\"{col[1].replace('\\', '\\\\').replace('"', '""')}\" TEXT"
-                    for col in columns if col[1]
-                ]
-                column_names = [
-                    f"\"{col[1].replace('\\', '\\\\').replace('"', '""')}\""
-                    for col in columns if col[1]
-                ]
-
-                if not column_definitions:
-                    print(f"Skipping table {table_name}: No valid column definitions.")
-                    continue
-
-                # Create table schema in PostgreSQL
-                create_table_query = f"CREATE TABLE \"{table_name}\" ({', '.join(column_definitions)});"
-                print(f"Creating table with query: {create_table_query}")
-                target_pg_cursor.execute(create_table_query)
-
-                # Fetch data from SQLite table
-                sqlite_cursor.execute(f"SELECT * FROM {table_name};")
-                rows = sqlite_cursor.fetchall()
-
-                # Skip empty tables
-                if not rows:
-                    print(f"Skipping table {table_name}: No data found.")
-                    continue
-
-                # Insert data into PostgreSQL
-                placeholders = ", ".join(["%s"] * len(column_names))
-                insert_query = f"INSERT INTO \"{table_name}\" ({', '.join(column_names)}) VALUES ({placeholders});"
-
-                for row in rows:
-                    try:
-                        # Check row length
-                        if len(row) != len(column_names):
-                            print(f"Skipping row due to mismatched length: {row}")
-                            continue
-
-                        # print(f"Inserting row: {row}")
-                        target_pg_cursor.execute(insert_query, row)
-                    except Exception as row_error:
-                        print(f"Error inserting row {row} into table {table_name}: {row_error}")
-                        continue
-
-            except Exception as table_error:
-                print(f"Error migrating table {table_name}: {table_error}")
-                continue
 
-        target_pg_conn.commit()
-        print(f"Migration of {sqlite_file} to {db_name} completed.")
+def add_dev_table_keys(tables, primary_keys, foreign_keys, schema):
+    """
+    Complete the keys declared in SQLite with the primary and foreign keys of a dev_tables.json schema.
+    Its names are matched case-insensitively to the SQLite tables and columns.
+    """
+    table_names = {table.lower(): table for table in tables}
+    columns = []
+    for table_idx, column in schema["column_names_original"]:
+        table = table_names.get(schema["table_names_original"][table_idx].lower()) if table_idx >= 0 else None
+        names = {name.lower(): name for name, _ in tables.get(table, [])}
+        columns.append((table, names.get(column.lower())))
+
+    for key in schema["primary_keys"]:
+        key_columns = [columns[idx] for idx in (key if isinstance(key, list) else [key])]
+        table = key_columns[0][0]
+        if table and table not in primary_keys and all(t == table and c for t, c in key_columns):
+            primary_keys[table] = [column for _, column in key_columns]
+
+    known = {(table, tuple(cols)) for table, cols, _, _ in foreign_keys}
+    for from_idx, to_idx in schema["foreign_keys"]:
+        (table, column), (ref_table, ref_column) = columns[from_idx], columns[to_idx]
+        if table and column and ref_table and ref_column and (table, (column,)) not in known:
+            known.add((table, (column,)))
+            foreign_keys.append((table, [column], ref_table, [ref_column]))
+
+
+def pg_type(declared_type):
+    """
+    PostgreSQL type for a SQLite declared type, following SQLite's affinity rules, and the
+    SQLite condition a non-NULL value must meet to be loaded as that type.
+    BLOB, boolean and untyped columns stay TEXT.
+    """
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return "BIGINT", "typeof({col}) = 'integer'"
+    if any(name in declared_type for name in ("CHAR", "CLOB", "TEXT")):
+        return "TEXT", None
+    if any(name in declared_type for name in ("REAL", "FLOA", "DOUB")):
+        return "DOUBLE PRECISION", "typeof({col}) IN ('integer', 'real')"
+    if "DATETIME" in declared_type or "TIMESTAMP" in declared_type:
+        return "TIMESTAMP", "typeof({col}) = 'text' AND {col} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'"
+    if "DATE" in declared_type:
+        return "DATE", "typeof({col}) = 'text' AND {col} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'"
+    if "DEC" in declared_type or "NUMERIC" in declared_type:
+        return "NUMERIC", "typeof({col}) IN ('integer', 'real')"
+    return "TEXT", None
+
+
+def column_types(sqlite_conn, table_name, columns):
+    """
+    PostgreSQL types of a table's columns. SQLite does not enforce declared types, so a column
+    falls back to TEXT if any of its values does not fit the mapped type.
+    """
+    types = [pg_type(declared_type) for _, declared_type in columns]
+    checks = [
+        (i, condition.format(col=sqlite_identifier(name)))
+        for i, ((name, _), (_, condition)) in enumerate(zip(columns, types)) if condition
+    ]
+    result = [type_name for type_name, _ in types]
+    if not checks:
+        return result
+    mismatches = sqlite_conn.execute(
+        "SELECT " + ", ".join(
+            f"COUNT(*) FILTER (WHERE {sqlite_identifier(columns[i][0])} IS NOT NULL AND NOT ({condition}))"
+            for i, condition in checks
+        ) + f" FROM {sqlite_identifier(table_name)};"
+    ).fetchone()
+    for (i, _), count in zip(checks, mismatches):
+        if count:
+            print(f"Column {table_name}.{columns[i][0]}: {count} values are not {result[i]}, keeping TEXT.")
+            result[i] = "TEXT"
+    return result
+
+
+def copy_value(value):
+    """Encode one value in the COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            return "\\\\x" + value.hex()
+    value = str(value)
+    # PostgreSQL text cannot hold NUL characters
+    return (
+        value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+        .replace("\r", "\\r").replace("\x00", "")
+    )
+
+
+class CopyStream:
+    """
+    File-like reader over SQLite rows encoded for `COPY FROM STDIN`.
+    Only one fetchmany chunk of rows is held in memory at a time.
+    """
+    def __init__(self, sqlite_cursor, chunk_size=CHUNK_SIZE):
+        self.sqlite_cursor = sqlite_cursor
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.rows = 0
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            rows = self.sqlite_cursor.fetchmany(self.chunk_size)
+            if not rows:
+                self.done = True
+                break
+            self.rows += len(rows)
+            self.buffer += "".join(
+                "\t".join(map(copy_value, row)) + "\n" for row in rows
+            ).encode("utf-8")
+        if size < 0:
+            size = len(self.buffer)
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return chunk
+
+    readline = read
+
+
+COPY_ERROR_COLUMN = re.compile(r"^COPY .*?, line \d+, column (.*?)(?:: |$)", re.MULTILINE)
+
+
+def copy_table(sqlite_file, db_name, table_name, columns, pg, chunk_size=CHUNK_SIZE):
+    """
+    Create one table in PostgreSQL with the mapped column types and stream its rows into it with COPY.
+    If the data still does not fit the types, the table is reloaded with TEXT columns.
+    Runs in a worker process with its own connections.
 
+    Returns:
+        tuple: db_name, table_name, copied rows, seconds and the error message, if any.
+    """
+    started = time.perf_counter()
+    sqlite_conn = sqlite3.connect(sqlite_file)
+    # Replace undecodable bytes in TEXT values instead of failing the table
+    sqlite_conn.text_factory = lambda value: value.decode("utf-8", errors="replace")
+    target_pg_conn = psycopg2.connect(dbname=db_name, **pg)
+    stream = None
+    try:
+        column_names = [name for name, _ in columns]
+        types = column_types(sqlite_conn, table_name, columns)
+        with target_pg_conn.cursor() as target_pg_cursor:
+            # The load is repeatable, so a crash may lose it
+            target_pg_cursor.execute("SET synchronous_commit = off;")
+            identifiers = sql.SQL(", ").join(sql.Identifier(column) for column in column_names)
+            while True:
+                target_pg_cursor.execute(
+                    sql.SQL("CREATE TABLE {table} ({columns});").format(
+                        table=sql.Identifier(table_name),
+                        columns=sql.SQL(", ").join(
+                            sql.SQL("{} {}").format(sql.Identifier(column), sql.SQL(column_type))
+                            for column, column_type in zip(column_names, types)
+                        ),
+                    )
+                )
+                sqlite_cursor = sqlite_conn.execute(
+                    f"SELECT {', '.join(map(sqlite_identifier, column_names))} FROM {sqlite_identifier(table_name)};"
+                )
+                stream = CopyStream(sqlite_cursor, chunk_size)
+                try:
+                    target_pg_cursor.copy_expert(
+                        sql.SQL("COPY {table} ({columns}) FROM STDIN").format(
+                            table=sql.Identifier(table_name), columns=identifiers
+                        ).as_string(target_pg_conn),
+                        stream,
+                        size=1 << 20,
+                    )
+                    break
+                except psycopg2.DataError as e:
+                    if all(column_type == "TEXT" for column_type in types):
+                        raise
+                    # e.g. an out of range date that passed the GLOB check, the error context names the column
+                    match = COPY_ERROR_COLUMN.search(e.diag.context or "")
+                    column = match.group(1) if match else None
+                    if column in column_names and types[column_names.index(column)] != "TEXT":
+                        types[column_names.index(column)] = "TEXT"
+                    else:
+                        column, types = "all columns", ["TEXT"] * len(column_names)
+                    print(f"Reloading table {db_name}.{table_name} with {column} as TEXT: {e.diag.message_primary}")
+                    target_pg_conn.rollback()
+                    target_pg_cursor.execute("SET synchronous_commit = off;")
+        target_pg_conn.commit()
+        return db_name, table_name, stream.rows, time.perf_counter() - started, None
     except Exception as e:
-        print(f"Error migrating {sqlite_file} to {db_name}: {e}")
+        target_pg_conn.rollback()
+        rows = stream.rows if stream else 0
+        return db_name, table_name, rows, time.perf_counter() - started, str(e)
     finally:
         sqlite_conn.close()
         target_pg_conn.close()
 
-# Walk through all .sqlite files in the directory
-for root, _, files in os.walk(SQLITE_DIR):
-    for file in files:
-        if file.endswith(".sqlite"):
-            sqlite_file = os.path.join(root, file)
-            db_name = os.path.splitext(file)[0]
-            print(f"Processing {sqlite_file}...")
 
-            # Drop and recreate the PostgreSQL database
-            drop_and_create_database(db_name)
+def finalize_database(db_name, primary_keys, foreign_keys, pg):
+    """
+    Add the primary keys, index the foreign key columns, add the foreign keys and analyze a loaded database.
+    Keys are added after COPY, and a key the data violates is reported and replaced by a plain index.
+    """
+    started = time.perf_counter()
+    target_pg_conn = psycopg2.connect(dbname=db_name, **pg)
+    target_pg_conn.autocommit = True
+    indexed = set()
+
+    def execute(statement, description):
+        try:
+            with target_pg_conn.cursor() as target_pg_cursor:
+                target_pg_cursor.execute(statement)
+            return True
+        except psycopg2.Error as e:
+            print(f"Skipping {description} in {db_name}: {str(e).strip()}")
+            return False
+
+    def columns_sql(columns):
+        return sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+
+    def create_index(table, columns):
+        # An index also serves lookups on any prefix of its columns
+        if any(key[0] == table and key[1][:len(columns)] == tuple(columns) for key in indexed):
+            return
+        indexed.add((table, tuple(columns)))
+        execute(
+            sql.SQL("CREATE INDEX ON {table} ({columns});").format(
+                table=sql.Identifier(table), columns=columns_sql(columns)
+            ),
+            f"index on {table}({', '.join(columns)})",
+        )
+
+    try:
+        for table, columns in primary_keys.items():
+            if execute(
+                sql.SQL("ALTER TABLE {table} ADD PRIMARY KEY ({columns});").format(
+                    table=sql.Identifier(table), columns=columns_sql(columns)
+                ),
+                f"primary key {table}({', '.join(columns)})",
+            ):
+                indexed.add((table, tuple(columns)))
+            else:
+                create_index(table, columns)
+
+        for table, columns, ref_table, ref_columns in foreign_keys:
+            create_index(table, columns)
+            execute(
+                sql.SQL("ALTER TABLE {table} ADD FOREIGN KEY ({columns}) REFERENCES {ref_table} ({ref_columns});").format(
+                    table=sql.Identifier(table),
+                    columns=columns_sql(columns),
+                    ref_table=sql.Identifier(ref_table),
+                    ref_columns=columns_sql(ref_columns),
+                ),
+                f"foreign key {table}({', '.join(columns)}) -> {ref_table}({', '.join(ref_columns)})",
+            )
+
+        # Statistics for the planner, and the visibility map for index-only scans
+        with target_pg_conn.cursor() as target_pg_cursor:
+            target_pg_cursor.execute("VACUUM ANALYZE;")
+    finally:
+        target_pg_conn.close()
+    return db_name, len(indexed), time.perf_counter() - started
+
+
+def invalidate_query_cache(db_name):
+    """
+    Drop the app's cached query results for a reloaded database.
+    Bumping the database version in the QUERY_CACHE_PATH file (see QueryResultCache in
+    app/db/service.py) also expires the in-memory entries of running servers.
+    """
+    cache_path = os.getenv("QUERY_CACHE_PATH")
+    if not cache_path or not os.path.exists(cache_path):
+        return
+    cache_conn = sqlite3.connect(cache_path, timeout=30)
+    try:
+        with cache_conn:
+            cache_conn.execute("CREATE TABLE IF NOT EXISTS db_versions (db_id TEXT PRIMARY KEY, version INTEGER)")
+            cache_conn.execute(
+                "INSERT INTO db_versions VALUES (?, 1) ON CONFLICT (db_id) DO UPDATE SET version = version + 1",
+                (db_name,),
+            )
+            cache_conn.execute("DELETE FROM query_results WHERE db_id = ?", (db_name,))
+        print(f"Invalidated cached query results of {db_name}.")
+    except Exception as e:
+        print(f"Error invalidating cached query results of {db_name}: {e}")
+    finally:
+        cache_conn.close()
+
+
+def find_sqlite_files(sqlite_dir, databases=None):
+    """Map database names to the .sqlite files below a directory, optionally only the given databases."""
+    sqlite_files = {}
+    for root, _, files in os.walk(sqlite_dir):
+        for file in files:
+            db_name, extension = os.path.splitext(file)
+            if extension == ".sqlite" and (not databases or db_name in databases):
+                sqlite_files[db_name] = os.path.join(root, file)
+    return sqlite_files
+
+
+def migrate(sqlite_files, pg=None, workers=None, chunk_size=CHUNK_SIZE, dev_tables_path=DEV_TABLES_PATH):
+    """
+    Migrate SQLite databases to PostgreSQL, copying all of their tables in parallel,
+    then add keys and indexes and analyze each database.
+
+    Args:
+        sqlite_files (dict): Database name -> SQLite file.
+        pg (dict): PostgreSQL connection parameters, see `pg_settings`.
+        workers (int): Worker processes, defaults to the CPU count.
+        chunk_size (int): Rows per SQLite fetch.
+        dev_tables_path (str): dev_tables.json with additional primary and foreign keys.
+
+    Returns:
+        list[tuple]: (db_name, table_name, rows, seconds, error) per table.
+    """
+    pg = pg or pg_settings()
+    dev_tables = load_dev_tables(dev_tables_path)
+    tasks, keys = [], {}
+    for db_name, sqlite_file in sqlite_files.items():
+        print(f"Processing {sqlite_file}...")
+        tables, primary_keys, foreign_keys = read_schema(sqlite_file)
+        if not tables:
+            print(f"No tables found in SQLite database {sqlite_file}. Skipping.")
+            continue
+        if db_name in dev_tables:
+            add_dev_table_keys(tables, primary_keys, foreign_keys, dev_tables[db_name])
+        keys[db_name] = (primary_keys, foreign_keys)
+        drop_and_create_database(db_name, pg)
+        for table_name, columns in tables.items():
+            if columns:
+                tasks.append((sqlite_file, db_name, table_name, columns))
+            else:
+                print(f"Skipping table {table_name}: No columns found.")
+
+    results = []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(copy_table, sqlite_file, db_name, table_name, columns, pg, chunk_size)
+            for sqlite_file, db_name, table_name, columns in tasks
+        ]
+        for future in as_completed(futures):
+            db_name, table_name, rows, seconds, error = future.result()
+            results.append((db_name, table_name, rows, seconds, error))
+            if error:
+                print(f"Error migrating table {db_name}.{table_name}: {error}")
+            else:
+                print(
+                    f"Migrated table {db_name}.{table_name}: {rows} rows in {seconds:.1f}s "
+                    f"({rows / max(seconds, 1e-9):,.0f} rows/s)"
+                )
+
+        total_rows = sum(rows for _, _, rows, _, error in results if not error)
+        elapsed = time.perf_counter() - started
+        print(f"Copied {total_rows} rows in {elapsed:.1f}s ({total_rows / max(elapsed, 1e-9):,.0f} rows/s).")
+
+        futures = [
+            executor.submit(finalize_database, db_name, primary_keys, foreign_keys, pg)
+            for db_name, (primary_keys, foreign_keys) in keys.items()
+        ]
+        for future in as_completed(futures):
+            db_name, indexes, seconds = future.result()
+            print(f"Indexed and analyzed {db_name}: {indexes} indexes in {seconds:.1f}s")
+            print(f"Migration of {sqlite_files[db_name]} to {db_name} completed.")
+            # Cached results of the old data are stale now
+            invalidate_query_cache(db_name)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate BIRD SQLite databases to PostgreSQL.")
+    parser.add_argument("sqlite_dir", nargs="?", default=os.getenv("SQLITE_DIR"),
+                        help="Directory searched recursively for .sqlite files (default: $SQLITE_DIR)")
+    parser.add_argument("--databases", nargs="*", help="Only migrate these databases")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows per SQLite fetch")
+    parser.add_argument("--dev-tables", default=DEV_TABLES_PATH, help="dev_tables.json with additional keys")
+    parser.add_argument("--pg-user")
+    parser.add_argument("--pg-host")
+    parser.add_argument("--pg-port", type=int)
+    parser.add_argument("--pg-password")
+    args = parser.parse_args(argv)
+    if not args.sqlite_dir:
+        parser.error("sqlite_dir is required when SQLITE_DIR is not set")
+
+    sqlite_files = find_sqlite_files(os.path.expanduser(args.sqlite_dir), args.databases)
+    pg = pg_settings(args.pg_user, args.pg_host, args.pg_port, args.pg_password)
+    results = migrate(sqlite_files, pg, args.workers, args.chunk_size, args.dev_tables)
 
-            # Migrate SQLite database to PostgreSQL
-            migrate_sqlite_to_postgres(sqlite_file, db_name)
+    failed = [(db_name, table_name) for db_name, table_name, _, _, error in results if error]
+    print("All migrations completed." if not failed else f"Migrations completed, {len(failed)} tables failed.")
 
-# Close PostgreSQL connection
-pg_cursor.close()
-pg_conn.close()
 
-print("All migrations completed.")
+if __name__ == "__main__":
+    main()